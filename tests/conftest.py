@@ -0,0 +1,36 @@
+import os
+import sys
+
+import pytest
+
+# The modules of the package import each other by their flat names, as when running main.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "vascusens"))
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+
+
+@pytest.fixture(scope="session")
+def engine():
+    """ The coarse engine of the preview preset, which keeps the forward solves fast """
+
+    from reconstruction import preset_engine
+
+    return preset_engine("preview")
+
+
+@pytest.fixture(scope="session")
+def frames():
+    """ Frames of every bundled recording at a few frequencies, with the baseline frames of the Second_Set """
+
+    from filehelpers import load_recording
+
+    baseline = load_recording(os.path.join(DATA_DIR, "Second_Set", "Baseline.xlsx"))
+    data, baseline_data = [], []
+    for data_set in sorted(os.listdir(DATA_DIR)):
+        for name in sorted(os.listdir(os.path.join(DATA_DIR, data_set))):
+            recording = load_recording(os.path.join(DATA_DIR, data_set, name))
+            for freq in (20, 60, 100):
+                data.append(recording.at_frequency(freq))
+                baseline_data.append(baseline.at_frequency(freq))
+
+    return data, baseline_data
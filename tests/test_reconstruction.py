@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+
+from reconstruction import (
+    BACKGROUND,
+    N_ANOMALIES,
+    anomaly_positions,
+    create_anomaly_batch,
+    preprocess,
+    preprocess_batch,
+)
+
+
+def set_perm(engine, anomaly):
+    """ The permittivities pyEIT assigns to an anomaly, which `anomaly_perm` and `anomaly_perms` reproduce """
+
+    import pyeit.mesh as mesh
+
+    mesh_obj = dict(engine.mesh_obj, perm=np.full(engine.mesh_obj["element"].shape[0], BACKGROUND))
+    return mesh.set_perm(mesh_obj, anomaly=anomaly, background=BACKGROUND)["perm"]
+
+
+def to_anomaly(frame_params):
+    """ The anomaly dictionaries of one frame of `preprocess_batch` parameters """
+
+    return [{"x": x, "y": y, "d": d, "perm": perm}
+            for (x, y), (d, perm) in zip(anomaly_positions(), frame_params[:N_ANOMALIES])]
+
+
+@pytest.mark.parametrize("flatten", [None, 2.5])
+@pytest.mark.parametrize("with_baseline", [False, True])
+def test_preprocess_batch_matches_preprocess(frames, flatten, with_baseline):
+    data, baseline_data = frames
+    baseline_data = baseline_data if with_baseline else [None] * len(data)
+
+    params = preprocess_batch(data, baseline_data if with_baseline else None, flatten)
+
+    for frame, baseline_frame, frame_params in zip(data, baseline_data, params):
+        anomaly = preprocess(frame, baseline_frame, flatten)
+        np.testing.assert_allclose([[attr["d"], attr["perm"]] for attr in anomaly], frame_params, rtol=1e-12)
+        np.testing.assert_allclose([[attr["x"], attr["y"]] for attr in anomaly], anomaly_positions(), atol=1e-12)
+
+
+def test_preprocess_batch_keeps_frames():
+    data = np.arange(64, dtype=np.float64).reshape(2, 32)
+    copy = data.copy()
+
+    preprocess_batch(data, data[::-1], 2.5)
+
+    np.testing.assert_array_equal(data, copy)
+
+
+def test_create_anomaly_batch_flat_frame():
+    # A flat frame has no range to interpolate the radius over, its anomalies get a NaN radius
+    params = create_anomaly_batch(np.full((1, 32), 5.0))
+
+    assert np.all(np.isnan(params[0, :, 0]))
+    np.testing.assert_array_equal(params[0, :, 1], 5.0)
+
+
+def test_anomaly_perms_match_set_perm(engine, frames):
+    data, baseline_data = frames
+    params = np.concatenate([preprocess_batch(data), preprocess_batch(data, baseline_data, 2.5),
+                             preprocess_batch(np.full(32, 5.0))])
+
+    perms = engine.anomaly_perms(params)
+
+    for frame_params, perm in zip(params, perms):
+        anomaly = to_anomaly(frame_params)
+        expected = set_perm(engine, anomaly)
+        np.testing.assert_array_equal(perm, expected)
+        np.testing.assert_array_equal(engine.anomaly_perm(anomaly), expected)
+
+
+def test_anomaly_perms_flat_frame_covers_nothing(engine):
+    perms = engine.anomaly_perms(preprocess_batch(np.full(32, 5.0)))
+
+    np.testing.assert_array_equal(perms, BACKGROUND)
+
+
+def test_low_rank_matches_full_solve(engine, frames):
+    data, baseline_data = frames
+    perms = engine.anomaly_perms(np.concatenate([preprocess_batch(data), preprocess_batch(data, baseline_data, 1.0)]))
+
+    np.testing.assert_allclose(engine.exact_voltages(perms), engine._full_voltages(perms), rtol=1e-9, atol=1e-10)
+
+
+def test_exact_voltages_fall_back_to_full_solve(engine):
+    # A permittivity change on every element touches all nodes, which is solved in full
+    n_tri = engine.mesh_obj["element"].shape[0]
+    perms = np.vstack([np.full(n_tri, BACKGROUND), np.full(n_tri, 3.0),
+                       np.linspace(1.0, 10.0, n_tri)])
+
+    assert engine._low_rank_potentials(perms[1]) is None
+    np.testing.assert_allclose(engine.exact_voltages(perms), engine._full_voltages(perms), rtol=1e-9, atol=1e-10)
+    np.testing.assert_allclose(engine.exact_voltages(perms[:1])[0], engine.v0, rtol=1e-9, atol=1e-10)
+
+
+def test_exact_voltages_match_pyeit(engine, frames):
+    from pyeit.eit.fem import Forward
+
+    data, _ = frames
+    perms = engine.anomaly_perms(preprocess_batch(data[:3]))
+    forward = Forward(engine.mesh_obj, engine.el_pos)
+
+    expected = [forward.solve_eit(engine.ex_mat, step=engine.params["step"], perm=perm, parser="std").v
+                for perm in perms]
+
+    np.testing.assert_allclose(engine.exact_voltages(perms), expected, rtol=1e-9, atol=1e-10)
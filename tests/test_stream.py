@@ -0,0 +1,90 @@
+import io
+
+import numpy as np
+import pytest
+
+from stream import BINARY_DTYPE, MAX_LINE_LENGTH, read_frames
+
+
+def read_all(data: bytes, framing: str, frame_size: int = 4):
+    """ Read every frame of a stream, collecting the errors of the skipped frames """
+
+    errors = []
+    frames = list(read_frames(io.BytesIO(data), framing, frame_size, on_bad_frame=errors.append))
+    return frames, errors
+
+
+def test_csv_frames():
+    frames, errors = read_all(b"1,2,3,4\n# comment\n\n5 6 7 8\r\n9, 10,11 ,12", "csv")
+
+    np.testing.assert_array_equal(frames, [[1, 2, 3, 4], [5, 6, 7, 8], [9, 10, 11, 12]])
+    assert errors == []
+
+
+def test_csv_skips_malformed_frames():
+    data = b"1,2,3\n1,2,3,4,5\n1,2,x,4\n1,nan,3,4\n" + b"1," * MAX_LINE_LENGTH + b"\n5,6,7,8\n"
+
+    frames, errors = read_all(data, "csv")
+
+    np.testing.assert_array_equal(frames, [[5, 6, 7, 8]])
+    assert len(errors) == 5
+    assert all(isinstance(error, ValueError) for error in errors)
+
+
+def test_csv_raises_without_handler():
+    with pytest.raises(ValueError):
+        list(read_frames(io.BytesIO(b"1,2,3\n"), "csv", 4, on_bad_frame=None))
+
+
+def test_binary_frames():
+    values = np.arange(12, dtype=BINARY_DTYPE)
+
+    frames, errors = read_all(values.tobytes(), "binary")
+
+    np.testing.assert_array_equal(frames, values.reshape(3, 4))
+    assert errors == []
+
+
+class TrickleReader(io.RawIOBase):
+    """ A stream returning at most a few bytes per read, like a pipe or socket """
+
+    def __init__(self, data: bytes, chunk: int = 3):
+        self.data = io.BytesIO(data)
+        self.chunk = chunk
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.data.read(min(self.chunk, len(buffer)))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def test_binary_partial_reads():
+    values = np.arange(8, dtype=BINARY_DTYPE)
+
+    frames = list(read_frames(TrickleReader(values.tobytes()), "binary", 4))
+
+    np.testing.assert_array_equal(frames, values.reshape(2, 4))
+
+
+def test_binary_skips_non_finite_frames():
+    values = np.array([1, np.inf, 3, 4, 5, 6, 7, 8], dtype=BINARY_DTYPE)
+
+    frames, errors = read_all(values.tobytes(), "binary")
+
+    np.testing.assert_array_equal(frames, [[5, 6, 7, 8]])
+    assert len(errors) == 1
+
+
+def test_binary_truncated_frame():
+    data = np.arange(6, dtype=BINARY_DTYPE).tobytes()
+
+    with pytest.raises(ValueError, match="middle of a frame"):
+        read_all(data, "binary")
+
+
+def test_unknown_framing():
+    with pytest.raises(ValueError, match="Unknown framing"):
+        list(read_frames(io.BytesIO(b""), "json"))
@@ -0,0 +1,297 @@
+import glob
+import multiprocessing.util
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import matplotlib
+
+# Batch runs never open a window, so render without a display
+matplotlib.use("Agg")
+
+import numpy as np  # noqa: E402
+
+import instrument  # noqa: E402
+from export import export_png  # noqa: E402
+from filehelpers import RECORDING_EXTENSION, Recording, is_converted  # noqa: E402
+from reconstruction import ReconstructionEngine, get_engine, reconstruct_sweep  # noqa: E402
+
+# File extensions picked up when a directory is given as input
+INPUT_EXTENSIONS = (".xlsx", RECORDING_EXTENSION)
+
+# Baseline recording and reconstruction engine of the worker process, loaded once by `_init_worker`
+_baseline = None
+_engine = None
+
+
+def find_inputs(patterns: list[str]):
+    """ Expand directories and glob patterns into a sorted list of recording paths
+
+    Where a spreadsheet and the recording converted from it share a directory and name, only the converted `.npz`
+    recording is included, unless the spreadsheet was changed after the conversion.
+
+    Parameters
+    ----------
+    patterns : list[str]
+        path strings of directories, whose recordings are all included, or glob patterns
+
+    Returns
+    -------
+    list[str]
+        path strings of the recordings found
+    """
+
+    paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            paths.update(
+                os.path.join(pattern, name) for name in os.listdir(pattern)
+                if name.lower().endswith(INPUT_EXTENSIONS) and not name.startswith("~$")
+            )
+        else:
+            paths.update(glob.glob(pattern, recursive=True))
+
+    # A recording converted by `convert` sits next to its spreadsheet, keep only the converted one while it holds the
+    # current contents of the spreadsheet
+    recordings = {}
+    for path in sorted(paths):
+        recordings.setdefault(os.path.splitext(path)[0], []).append(path)
+
+    inputs = []
+    for stem_paths in recordings.values():
+        converted = [path for path in stem_paths if path.lower().endswith(RECORDING_EXTENSION)]
+        spreadsheets = [path for path in stem_paths if path.lower().endswith(".xlsx")]
+        if converted and (not spreadsheets or is_converted(converted[0], spreadsheets[0])):
+            inputs.append(converted[0])
+        else:
+            inputs.append((spreadsheets or stem_paths)[0])
+
+    return sorted(inputs)
+
+
+def output_dirs(input_paths: list[str], output_dir: str):
+    """ Return the directory to write the results of every recording to
+
+    The directories of the recordings are mirrored under `output_dir` relative to their common directory, so that
+    recordings with the same name in different directories do not overwrite each other's results.
+
+    Parameters
+    ----------
+    input_paths : list[str]
+        path strings of the recordings
+    output_dir : str
+        directory to write the results to
+
+    Returns
+    -------
+    dict[str, str]
+        the output directory of each recording
+
+    Raises
+    ------
+    ValueError
+        if two recordings would write the same results, or the results would be written to a directory holding
+        recordings
+    """
+
+    if not input_paths:
+        return {}
+
+    input_dirs = [os.path.dirname(os.path.abspath(path)) for path in input_paths]
+    common_dir = os.path.commonpath(input_dirs)
+    dirs = {path: os.path.normpath(os.path.join(output_dir, os.path.relpath(input_dir, common_dir)))
+            for path, input_dir in zip(input_paths, input_dirs)}
+
+    # Results are named after the recording, so recordings differing only in extension would share them
+    names = {}
+    for path, directory in dirs.items():
+        name = os.path.join(os.path.realpath(directory), os.path.splitext(os.path.basename(path))[0])
+        if name in names:
+            raise ValueError("Recordings '" + names[name] + "' and '" + path + "' would write the same results")
+        names[name] = path
+
+    # A `<name>.npz` result would overwrite a converted recording
+    recording_dirs = {os.path.realpath(input_dir) for input_dir in input_dirs}
+    for directory in dirs.values():
+        if os.path.realpath(directory) in recording_dirs:
+            raise ValueError("The output directory '" + directory + "' holds recordings being processed, choose " +
+                             "another output directory")
+
+    return dirs
+
+
+def parse_frequencies(text: str):
+    """ Parse a frequency list such as "20,50,90" or "20-100" into a list of frequencies
+
+    Parameters
+    ----------
+    text : str
+        comma separated frequencies or inclusive frequency ranges
+
+    Returns
+    -------
+    list[int]
+        the frequencies in the order given
+    """
+
+    freqs = []
+    for item in text.split(","):
+        if "-" in item:
+            start, stop = item.split("-")
+            freqs.extend(range(int(start), int(stop) + 1))
+        else:
+            freqs.append(int(item))
+
+    for freq in freqs:
+        if freq not in range(20, 101):
+            raise ValueError("Please enter whole number frequencies between 20 and 100 inclusive")
+
+    return freqs
+
+
+def _init_worker(baseline_path: str, shared_engine: dict):
+    """ Attach to the reconstruction engine shared by the main process and load the baseline once per worker process
+    """
+
+    global _baseline, _engine
+
+    # Worker processes exit without running atexit handlers, so write their trace from a multiprocessing finaliser
+    if instrument.enabled():
+        multiprocessing.util.Finalize(None, instrument.flush, exitpriority=0)
+
+    _engine = ReconstructionEngine.attach(shared_engine)
+    _baseline = Recording.load(baseline_path) if baseline_path else None
+
+
+def process_recording(input_path: str, freqs: list[int], flatten: float, output_dir: str, figures: bool = False):
+    """ Reconstruct one recording at every requested frequency and write the results
+
+    Writes a `<name>.npz` file holding the frequencies and the n_freq x ny x nx stack of reconstructed images, and a
+    `<name>_<freq>Hz.png` heatmap image per frequency. The heatmaps are written directly from the arrays by `export`
+    unless full matplotlib figures with a colour bar are requested.
+
+    Parameters
+    ----------
+    input_path : str
+        path string of the recording
+    freqs : list[int]
+        the frequencies to reconstruct
+    flatten : float
+        the number of standard deviations to which data normalisation should flatten high values, will not flatten if
+        `None`
+    output_dir : str
+        directory to write the results to
+    figures : bool, optional
+        whether to render full matplotlib figures instead of plain heatmaps, by default `False`
+
+    Returns
+    -------
+    list[str]
+        path strings of the files written
+    """
+
+    with instrument.stage("process_recording", file=os.path.basename(input_path)):
+        return _process_recording(input_path, freqs, flatten, output_dir, figures)
+
+
+def _process_recording(input_path: str, freqs: list[int], flatten: float, output_dir: str, figures: bool):
+    """ Reconstruct one recording and write the results, see `process_recording` """
+
+    name = os.path.splitext(os.path.basename(input_path))[0]
+    recording = Recording.load(input_path)
+
+    # Reconstruct every frequency in one batched solve
+    images = reconstruct_sweep(recording, _baseline, freqs=freqs, flatten=flatten, engine=_engine)
+
+    # Numeric results
+    written = [os.path.join(output_dir, name + ".npz")]
+    np.savez(written[0], frequencies=np.array(freqs), ds=images)
+
+    # Heatmap images
+    for freq, ds in zip(freqs, images):
+        written.append(os.path.join(output_dir, name + "_" + str(freq) + "Hz.png"))
+        if figures:
+            # Imported here as pyplot is slow to import and not needed for plain heatmaps
+            import matplotlib.pyplot as plt
+            from visualisation import plot_reconstruction
+
+            fig = plot_reconstruction(ds)
+            fig.savefig(written[-1])
+            plt.close(fig)
+        else:
+            export_png(written[-1], ds)
+
+    return written
+
+
+def run_batch(input_paths: list[str], output_dir: str, freqs: list[int], baseline_path: str = "",
+              flatten: float = None, workers: int = None, figures: bool = False, engine_params: dict = None,
+              progress=None):
+    """ Process many recordings in parallel with a pool of worker processes
+
+    Parameters
+    ----------
+    input_paths : list[str]
+        path strings of the recordings to process
+    output_dir : str
+        directory to write the results to, mirroring the directories of the recordings, see `output_dirs`
+    freqs : list[int]
+        the frequencies to reconstruct
+    baseline_path : str, optional
+        path string of the baseline recording, by default ""
+    flatten : float, optional
+        the number of standard deviations to which data normalisation should flatten high values, will not flatten if
+        `None`, by default `None`
+    workers : int, optional
+        number of worker processes, by default the number of CPUs
+    figures : bool, optional
+        whether to render full matplotlib figures instead of plain heatmaps, by default `False`
+    engine_params : dict, optional
+        parameters of the reconstruction engine, e.g. `PRESETS["diagnostic"]`, see `get_engine`, by default the
+        default engine
+    progress : callable, optional
+        called as `progress(input_path, error)` as each recording finishes, with `error` `None` on success
+
+    Returns
+    -------
+    dict[str, Exception]
+        the error raised for each recording that could not be processed
+
+    Raises
+    ------
+    ValueError
+        if recordings would overwrite each other's results or the recordings themselves, see `output_dirs`
+    """
+
+    dirs = output_dirs(input_paths, output_dir)
+    for directory in set(dirs.values()) | {output_dir}:
+        os.makedirs(directory, exist_ok=True)
+
+    # Check the baseline here, a failing worker initialiser would break the whole pool
+    if baseline_path:
+        Recording.load(baseline_path)
+
+    # Build the engine once up front and share its arrays, so that every worker attaches to one copy in shared
+    # memory instead of loading or building its own
+    engine = get_engine(**(engine_params or {}))
+    shared_engine = engine.share()
+
+    failures = {}
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(baseline_path, shared_engine)) as executor:
+            futures = {
+                executor.submit(process_recording, input_path, freqs, flatten, dirs[input_path], figures): input_path
+                for input_path in input_paths
+            }
+
+            for future in as_completed(futures):
+                error = future.exception()
+                if error is not None:
+                    failures[futures[future]] = error
+
+                if progress is not None:
+                    progress(futures[future], error)
+    finally:
+        engine.unshare()
+
+    return failures
@@ -0,0 +1,365 @@
+import json
+import os
+import platform
+import statistics
+import tempfile
+import time
+
+import matplotlib
+
+# Benchmarks never open a window, so render without a display
+matplotlib.use("Agg")
+
+import numpy as np  # noqa: E402
+import pyeit  # noqa: E402
+
+from export import export_png  # noqa: E402
+from filehelpers import FREQUENCIES, Recording  # noqa: E402
+from reconstruction import (  # noqa: E402
+    BACKGROUND,
+    ReconstructionEngine,
+    baseline_correction,
+    clean_data,
+    create_anomaly,
+    normalise_data,
+    preprocess_batch,
+)
+
+# Version of the layout of the results file
+BENCHMARK_FORMAT_VERSION = 1
+
+# Bundled data sets, relative to this file, and the names of their baseline recordings
+DEFAULT_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
+BASELINE_NAMES = ("Baseline.xlsx", "Blockage_0.xlsx")
+
+# Default mesh densities, numbers of frequencies and repeats of every stage
+DEFAULT_H0 = (0.1, 0.08)
+DEFAULT_FREQUENCY_COUNTS = (1, 9, 81)
+DEFAULT_REPEAT = 3
+
+# Results slower than the previous run by more than this factor are reported as regressions
+DEFAULT_THRESHOLD = 1.2
+
+# Fields identifying the same measurement in two results files
+RESULT_KEY = ("stage", "dataset", "file", "h0", "n_freq")
+
+
+def time_call(func, repeat: int = DEFAULT_REPEAT):
+    """ Time a function call
+
+    Parameters
+    ----------
+    func : callable
+        the function to time, called without arguments
+    repeat : int, optional
+        number of calls, by default DEFAULT_REPEAT
+
+    Returns
+    -------
+    tuple[dict, object]
+        the minimum, median and mean wall time in seconds and the number of calls, and the result of the last call
+    """
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+
+    return {"min": min(times), "median": statistics.median(times), "mean": statistics.mean(times),
+            "repeat": repeat}, result
+
+
+def find_datasets(data_dir: str = DEFAULT_DATA_DIR):
+    """ Find the recordings and the baseline of every data set
+
+    Parameters
+    ----------
+    data_dir : str, optional
+        directory holding one directory of .xlsx recordings per data set, by default the bundled data
+
+    Returns
+    -------
+    dict[str, tuple[list[str], str]]
+        the path strings of the recordings and of the baseline recording, or "", of each data set by name
+    """
+
+    datasets = {}
+    for name in sorted(os.listdir(data_dir)):
+        dataset_dir = os.path.join(data_dir, name)
+        if not os.path.isdir(dataset_dir):
+            continue
+
+        files = sorted(
+            file for file in os.listdir(dataset_dir) if file.endswith(".xlsx") and not file.startswith("~$")
+        )
+        baselines = [file for file in files if file in BASELINE_NAMES]
+        baseline = os.path.join(dataset_dir, baselines[0]) if baselines else ""
+        recordings = [os.path.join(dataset_dir, file) for file in files if file not in BASELINE_NAMES]
+        if recordings:
+            datasets[name] = (recordings, baseline)
+
+    return datasets
+
+
+def benchmark_mesh(h0: float, data: list[float], repeat: int = DEFAULT_REPEAT):
+    """ Time the stages of the pyEIT pipeline that `greit_visualisation` originally ran for every image, and the
+    engine that replaces them
+
+    Parameters
+    ----------
+    h0 : float
+        mesh density
+    data : list[float]
+        preprocessed frame of data used for the stages that need an anomaly
+    repeat : int, optional
+        number of calls of every stage, by default DEFAULT_REPEAT
+
+    Returns
+    -------
+    tuple[list[dict], ReconstructionEngine]
+        a result per stage, and the engine for the mesh density
+    """
+
+    import pyeit.eit.greit as greit
+    import pyeit.mesh as mesh
+    from pyeit.eit.fem import Forward
+    from pyeit.eit.utils import eit_scan_lines
+    from pyeit.mesh.shape import circle
+
+    results = []
+
+    def record(stage, func):
+        timing, result = time_call(func, repeat)
+        results.append(dict(stage=stage, dataset="", file="", h0=h0, n_freq=1, **timing))
+        return result
+
+    anomaly = create_anomaly(data)
+    ex_mat = eit_scan_lines(16, 1)
+
+    # Reference pipeline, one frame at a time as in the original implementation
+    mesh_obj, el_pos = record("mesh.create", lambda: mesh.create(16, h0=h0, fd=circle))
+    mesh_new = record("mesh.set_perm", lambda: mesh.set_perm(mesh_obj, anomaly=anomaly, background=BACKGROUND))
+    fwd = Forward(mesh_obj, el_pos)
+    f0 = record("Forward.solve_eit homogeneous", lambda: fwd.solve_eit(ex_mat, step=1, perm=mesh_obj["perm"]))
+    f1 = record("Forward.solve_eit anomaly", lambda: fwd.solve_eit(ex_mat, step=1, perm=mesh_new["perm"]))
+    eit = record("GREIT.__init__", lambda: greit.GREIT(mesh_obj, el_pos, ex_mat=ex_mat, step=1, parser="std"))
+    record("GREIT.setup", lambda: eit.setup(p=0.50, lamb=0.001))
+    record("GREIT.solve", lambda: eit.mask_value(eit.solve(f1.v, f0.v), mask_value=np.NAN))
+
+    # Engine set up, built from scratch and loaded from the on-disk cache
+    record("engine build", lambda: ReconstructionEngine(h0=h0, use_cache=False))
+    ReconstructionEngine(h0=h0)
+    engine = record("engine load", lambda: ReconstructionEngine(h0=h0))
+
+    return results, engine
+
+
+def benchmark_recording(path: str, baseline_path: str, engine: ReconstructionEngine, h0: float, n_freqs: list[int],
+                        repeat: int = DEFAULT_REPEAT, figures: bool = True):
+    """ Time loading, preprocessing, reconstructing and rendering one recording at several numbers of frequencies
+
+    Parameters
+    ----------
+    path : str
+        path string of the .xlsx recording
+    baseline_path : str
+        path string of the .xlsx baseline recording, or ""
+    engine : ReconstructionEngine
+        the engine for the mesh density
+    h0 : float
+        mesh density of the engine
+    n_freqs : list[int]
+        numbers of frequencies to reconstruct, evenly spread between 20 and 100
+    repeat : int, optional
+        number of calls of every stage, by default DEFAULT_REPEAT
+    figures : bool, optional
+        whether to time rendering the matplotlib figure, by default `True`
+
+    Returns
+    -------
+    list[dict]
+        a result per stage and number of frequencies
+    """
+
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    from visualisation import ReconstructionFigure
+
+    dataset = os.path.basename(os.path.dirname(path))
+    results = []
+
+    def record(stage, func, n_freq=1, stage_h0=None):
+        timing, result = time_call(func, repeat)
+        results.append(dict(stage=stage, dataset=dataset, file=os.path.basename(path), h0=stage_h0, n_freq=n_freq,
+                            **timing))
+        return result
+
+    # Loading does not depend on the mesh, so it is only timed once per recording
+    recording = record("Recording.from_excel", lambda: Recording.from_excel(path))
+    baseline = Recording.from_excel(baseline_path) if baseline_path else None
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        npz_path = os.path.join(tmp_dir, "recording.npz")
+        recording.save(npz_path)
+        record("Recording.from_npz", lambda: Recording.from_npz(npz_path))
+
+    for n_freq in n_freqs:
+        freqs = [int(freq) for freq in np.linspace(FREQUENCIES[0], FREQUENCIES[-1], n_freq).round()]
+        frames = [recording.at_frequency(freq) for freq in freqs]
+        baseline_frames = [baseline.at_frequency(freq) if baseline else None for freq in freqs]
+
+        def preprocess_frames():
+            processed = []
+            for data, baseline_data in zip(frames, baseline_frames):
+                # clean_data sorts in place, so the frames are copied to keep every repeat on the same data
+                data = list(data)
+                if baseline_data is not None:
+                    data = baseline_correction(data, baseline_data)
+                processed.append(normalise_data(clean_data(data)))
+            return processed
+
+        processed = record("preprocess", preprocess_frames, n_freq)
+        anomalies = record("create_anomaly", lambda: [create_anomaly(data) for data in processed], n_freq)
+        params = record("preprocess_batch",
+                        lambda: preprocess_batch(frames, None if baseline is None else baseline_frames), n_freq)
+
+        # Batched engine stages
+        perms = record("engine.anomaly_perm", lambda: np.array([engine.anomaly_perm(x) for x in anomalies]),
+                       n_freq, h0)
+        record("engine.anomaly_perms", lambda: engine.anomaly_perms(params), n_freq, h0)
+        voltages = record("engine.forward_voltages", lambda: engine.forward_voltages(perms), n_freq, h0)
+        record("engine.linear_voltages", lambda: engine.linear_voltages(perms), n_freq, h0)
+        images = record("engine.solve", lambda: engine.solve(voltages), n_freq, h0)
+
+        # Rendering, one image per frequency
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            record("export_png", lambda: [export_png(os.path.join(tmp_dir, "image.png"), ds) for ds in images],
+                   n_freq, h0)
+
+        # Rendering a figure takes the same time for every image, so only the first image is timed
+        if figures and n_freq == n_freqs[0]:
+            def render():
+                figure = ReconstructionFigure(images[0], fig=Figure(constrained_layout=True))
+                FigureCanvasAgg(figure.fig).draw()
+
+            record("render figure", render, 1, h0)
+
+    return results
+
+
+def run_benchmarks(data_dir: str = DEFAULT_DATA_DIR, h0s=DEFAULT_H0, n_freqs=DEFAULT_FREQUENCY_COUNTS,
+                   repeat: int = DEFAULT_REPEAT, figures: bool = True, progress=None):
+    """ Time every stage of the reconstruction pipeline over the data sets, mesh densities and frequency counts
+
+    Parameters
+    ----------
+    data_dir : str, optional
+        directory holding one directory of .xlsx recordings per data set, by default the bundled data
+    h0s : list[float], optional
+        mesh densities, by default DEFAULT_H0
+    n_freqs : list[int], optional
+        numbers of frequencies, by default DEFAULT_FREQUENCY_COUNTS
+    repeat : int, optional
+        number of calls of every stage, by default DEFAULT_REPEAT
+    figures : bool, optional
+        whether to time rendering matplotlib figures, by default `True`
+    progress : callable, optional
+        called with a description of each benchmark as it starts
+
+    Returns
+    -------
+    dict
+        the environment the benchmarks ran in under "meta", and a result per stage under "results"
+    """
+
+    datasets = find_datasets(data_dir)
+    if not datasets:
+        raise FileNotFoundError("No data sets of .xlsx recordings were found in '" + data_dir + "'")
+
+    # A frame of real data for the stages that need an anomaly
+    recordings, baseline_path = next(iter(datasets.values()))
+    data = Recording.from_excel(recordings[0]).at_frequency(FREQUENCIES[-1])
+    if baseline_path:
+        data = baseline_correction(data, Recording.from_excel(baseline_path).at_frequency(FREQUENCIES[-1]))
+    data = normalise_data(clean_data(data))
+
+    results = []
+    for h0 in h0s:
+        if progress is not None:
+            progress("mesh h0=" + str(h0))
+        mesh_results, engine = benchmark_mesh(h0, data, repeat)
+        results.extend(mesh_results)
+
+        for name, (recordings, baseline_path) in datasets.items():
+            for path in recordings:
+                if progress is not None:
+                    progress(name + "/" + os.path.basename(path) + " h0=" + str(h0))
+                recording_results = benchmark_recording(path, baseline_path, engine, h0, n_freqs, repeat, figures)
+
+                # Loading and preprocessing do not depend on the mesh, keep them from the first mesh only
+                if h0 != h0s[0]:
+                    recording_results = [result for result in recording_results if result["h0"] is not None]
+                results.extend(recording_results)
+
+    meta = {
+        "format_version": BENCHMARK_FORMAT_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpus": os.cpu_count(),
+        "numpy": np.__version__,
+        "matplotlib": matplotlib.__version__,
+        "pyeit": getattr(pyeit, "__version__", None) or getattr(pyeit, "APP_VERSION", "unknown"),
+        "repeat": repeat,
+    }
+
+    return {"meta": meta, "results": results}
+
+
+def compare(old: dict, new: dict, threshold: float = DEFAULT_THRESHOLD):
+    """ Compare the minimum times of two benchmark runs
+
+    Parameters
+    ----------
+    old : dict
+        results of the earlier run, as returned by `run_benchmarks`
+    new : dict
+        results of the later run
+    threshold : float, optional
+        ratio of the new to the old time above which a stage counts as a regression, by default DEFAULT_THRESHOLD
+
+    Returns
+    -------
+    list[dict]
+        the old and new minimum time and their ratio of every stage in both runs, with a `regression` flag
+    """
+
+    old_results = {tuple(result[field] for field in RESULT_KEY): result for result in old["results"]}
+
+    comparison = []
+    for result in new["results"]:
+        key = tuple(result[field] for field in RESULT_KEY)
+        if key not in old_results:
+            continue
+
+        ratio = result["min"] / old_results[key]["min"] if old_results[key]["min"] > 0 else float("inf")
+        comparison.append(dict(zip(RESULT_KEY, key), old=old_results[key]["min"], new=result["min"], ratio=ratio,
+                               regression=ratio > threshold))
+
+    return comparison
+
+
+def save_results(path: str, results: dict):
+    """ Write benchmark results as a JSON file """
+
+    with open(path, "w") as file:
+        json.dump(results, file, indent=2)
+
+
+def load_results(path: str):
+    """ Read benchmark results written by `save_results` """
+
+    with open(path) as file:
+        return json.load(file)
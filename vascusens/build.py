@@ -11,7 +11,10 @@ build_exe_options = {
     "packages": ["tkinter", "matplotlib", "webbrowser", "pandas", "visualisation", "openpyxl", "typing",
                  "pyeit.eit.greit", "pyeit.mesh", "pyeit.eit.fem", "pyeit.eit.utils", "pyeit.mesh.shape",
                  "numpy", "matplotlib.pyplot"],
-    "include_files": ["vascusens_logo_icon.ico"]
+    "include_files": ["vascusens_logo_icon.ico"],
+    # Optional dependencies of matplotlib and pandas that the application never imports
+    "excludes": ["PyQt5", "PyQt6", "PySide2", "PySide6", "wx", "gi", "IPython", "jupyter_client", "notebook",
+                 "tornado", "sphinx", "pytest", "sqlalchemy", "tables", "pyarrow", "numba"]
 }
 
 setup(
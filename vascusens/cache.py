@@ -0,0 +1,156 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import warnings
+
+import numpy as np
+import pyeit
+
+# Bump when the set or meaning of the cached arrays changes so that stale entries are never loaded
+CACHE_VERSION = 2
+
+# Location and size limit of the cache, overridable through the environment
+DEFAULT_CACHE_DIR = os.environ.get(
+    "VASCUSENS_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "vascusens")
+)
+DEFAULT_MAX_SIZE = int(os.environ.get("VASCUSENS_CACHE_MAX_MB", 512)) * 1024 * 1024
+
+PYEIT_VERSION = getattr(pyeit, "__version__", None) or getattr(pyeit, "APP_VERSION", "unknown")
+
+MANIFEST_NAME = "manifest.json"
+
+
+def cache_key(**params):
+    """ Hash the reconstruction parameters, the pyEIT version and the cache version into a cache entry name
+
+    Parameters
+    ----------
+    **params
+        the parameters the cached arrays were built from, e.g. n_el, h0, p, lamb, el_dist and step
+
+    Returns
+    -------
+    str
+        hexadecimal key naming the cache entry
+    """
+
+    description = {"params": params, "pyeit": PYEIT_VERSION, "version": CACHE_VERSION}
+    encoded = json.dumps(description, sort_keys=True).encode("utf-8")
+
+    return hashlib.sha256(encoded).hexdigest()[:32]
+
+
+def load_arrays(key: str, cache_dir: str = None):
+    """ Load a cache entry as read-only memory-mapped arrays
+
+    Parameters
+    ----------
+    key : str
+        key of the cache entry, from `cache_key`
+    cache_dir : str, optional
+        cache directory, by default `DEFAULT_CACHE_DIR`
+
+    Returns
+    -------
+    dict[str, np.ndarray] | None
+        the cached arrays by name, or `None` if the entry does not exist or is unreadable
+    """
+
+    entry_dir = os.path.join(cache_dir or DEFAULT_CACHE_DIR, key)
+
+    try:
+        with open(os.path.join(entry_dir, MANIFEST_NAME)) as manifest_file:
+            manifest = json.load(manifest_file)
+
+        arrays = {
+            name: np.load(os.path.join(entry_dir, name + ".npy"), mmap_mode="r", allow_pickle=False)
+            for name in manifest["arrays"]
+        }
+
+        # Mark the entry as recently used for the eviction order
+        os.utime(entry_dir)
+    except (OSError, ValueError, KeyError):
+        return None
+
+    return arrays
+
+
+def save_arrays(key: str, arrays: dict, params: dict = None, cache_dir: str = None, max_size: int = DEFAULT_MAX_SIZE):
+    """ Store arrays as a cache entry and evict the least recently used entries above the size limit
+
+    The entry is written to a temporary directory and renamed into place, so concurrent processes never see a
+    partially written entry. Failing to write the cache only raises a warning.
+
+    Parameters
+    ----------
+    key : str
+        key of the cache entry, from `cache_key`
+    arrays : dict[str, np.ndarray]
+        the arrays to store by name
+    params : dict, optional
+        the parameters the arrays were built from, recorded in the manifest for reference
+    cache_dir : str, optional
+        cache directory, by default `DEFAULT_CACHE_DIR`
+    max_size : int, optional
+        maximum total size of the cache directory in bytes, by default `DEFAULT_MAX_SIZE`
+    """
+
+    cache_dir = cache_dir or DEFAULT_CACHE_DIR
+    entry_dir = os.path.join(cache_dir, key)
+    tmp_dir = entry_dir + ".tmp-" + str(os.getpid())
+
+    try:
+        os.makedirs(tmp_dir, exist_ok=True)
+
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_dir, name + ".npy"), np.ascontiguousarray(array), allow_pickle=False)
+
+        # The manifest is written last, an entry without it is never loaded
+        manifest = {"arrays": sorted(arrays), "params": params or {}, "pyeit": PYEIT_VERSION,
+                    "version": CACHE_VERSION, "created": time.time()}
+        with open(os.path.join(tmp_dir, MANIFEST_NAME), "w") as manifest_file:
+            json.dump(manifest, manifest_file)
+
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Another process stored the same entry first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        evict(cache_dir, max_size)
+    except OSError as error:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        warnings.warn("Could not write the reconstruction cache at '" + cache_dir + "': " + str(error))
+
+
+def evict(cache_dir: str = None, max_size: int = DEFAULT_MAX_SIZE):
+    """ Remove the least recently used cache entries until the cache is no larger than `max_size` bytes """
+
+    cache_dir = cache_dir or DEFAULT_CACHE_DIR
+
+    # Collect the size and last use of every complete entry
+    entries = []
+    for name in os.listdir(cache_dir):
+        entry_dir = os.path.join(cache_dir, name)
+        if not os.path.isfile(os.path.join(entry_dir, MANIFEST_NAME)):
+            continue
+
+        size = sum(entry.stat().st_size for entry in os.scandir(entry_dir) if entry.is_file())
+        entries.append((os.stat(entry_dir).st_mtime, size, entry_dir))
+
+    # Drop the oldest entries first
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, entry_dir in sorted(entries):
+        if total_size <= max_size:
+            break
+
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total_size -= size
+
+
+def clear(cache_dir: str = None):
+    """ Remove every entry from the cache """
+
+    shutil.rmtree(cache_dir or DEFAULT_CACHE_DIR, ignore_errors=True)
@@ -0,0 +1,180 @@
+import struct
+import zlib
+from functools import lru_cache
+
+import numpy as np
+
+import instrument
+from reconstruction import create_16_point_circle
+
+# Number of entries in the colour lookup table
+LUT_SIZE = 256
+
+# Default pixels per GREIT grid point, and the border in grid points left around the image for the electrode labels
+DEFAULT_SCALE = 8
+MARGIN = 3
+
+
+@lru_cache(maxsize=None)
+def colour_lut(cmap: str = "viridis"):
+    """ Return a LUT_SIZE x 4 RGBA uint8 lookup table of a matplotlib colour map """
+
+    from matplotlib import cm
+
+    return (getattr(cm, cmap)(np.linspace(0.0, 1.0, LUT_SIZE)) * 255).round().astype(np.uint8)
+
+
+@lru_cache(maxsize=None)
+def electrode_overlay(n: int, scale: int = DEFAULT_SCALE):
+    """ Render the outline, electrode markers and electrode labels of an n x n image once, as a transparent layer
+
+    The layer matches `visualisation.plot_reconstruction`, and is drawn with matplotlib's Agg canvas without pyplot.
+
+    Parameters
+    ----------
+    n : int
+        size of the GREIT grid
+    scale : int, optional
+        pixels per grid point, by default DEFAULT_SCALE
+
+    Returns
+    -------
+    np.ndarray
+        (n + 2 * MARGIN) * scale square RGBA uint8 array
+    """
+
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    from matplotlib.patches import Circle
+
+    size = (n + 2 * MARGIN) * scale
+    fig = Figure(figsize=(size / 100, size / 100), dpi=100)
+    fig.patch.set_alpha(0.0)
+    canvas = FigureCanvasAgg(fig)
+
+    # Axes covering the whole canvas, in the pixel coordinates of the grid like imshow
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.set_xlim(-0.5 - MARGIN, n - 0.5 + MARGIN)
+    ax.set_ylim(n - 0.5 + MARGIN, -0.5 - MARGIN)
+    ax.axis("off")
+
+    # Outline of the mesh
+    radius = n / 2
+    ax.add_patch(Circle((radius, radius), radius, color="black", fill=False))
+
+    # Position and name of the electrodes
+    points_arr = create_16_point_circle(radius, radius, radius)
+    x, y = points_arr.T
+    ax.plot(x, y, "ro", markersize=scale * 0.75)
+
+    points_arr = points_arr + np.array([.5, .5])
+    for i in range(0, len(points_arr) // 2):
+        ax.annotate(str(i + 1) + "A", xy=(points_arr[2 * i][0], points_arr[2 * i][1]), color="red", fontsize=scale)
+        ax.annotate(str(i + 1) + "B", xy=(points_arr[2 * i + 1][0], points_arr[2 * i + 1][1]), color="red",
+                    fontsize=scale)
+
+    canvas.draw()
+
+    return np.asarray(canvas.buffer_rgba()).copy()
+
+
+def render_array(ds: np.ndarray, vmin: float = None, vmax: float = None, scale: int = DEFAULT_SCALE,
+                 electrodes: bool = True, cmap: str = "viridis"):
+    """ Colour map a reconstructed image into an RGBA array without building a figure
+
+    Parameters
+    ----------
+    ds : np.ndarray
+        the reconstructed image on the GREIT grid, `NaN` outside of the mesh
+    vmin, vmax : float, optional
+        the values mapped to the ends of the colour map, by default the image minimum and maximum like imshow
+    scale : int, optional
+        pixels per grid point, by default DEFAULT_SCALE
+    electrodes : bool, optional
+        whether to draw the outline, electrode markers and labels, by default `True`
+    cmap : str, optional
+        name of the matplotlib colour map, by default "viridis"
+
+    Returns
+    -------
+    np.ndarray
+        RGBA uint8 image, transparent outside of the mesh
+    """
+
+    ds = np.real(ds)
+    mask = np.isnan(ds)
+    vmin = np.nanmin(ds) if vmin is None else vmin
+    vmax = np.nanmax(ds) if vmax is None else vmax
+
+    # Colour lookup, with the masked grid points left transparent
+    index = np.zeros(ds.shape, dtype=np.intp)
+    if vmax > vmin:
+        scaled = (np.where(mask, vmin, ds) - vmin) * (LUT_SIZE / (vmax - vmin))
+        index = np.clip(scaled, 0, LUT_SIZE - 1).astype(np.intp)
+    rgba = colour_lut(cmap)[index]
+    rgba[mask] = 0
+
+    # Nearest neighbour upscaling, then place the image inside the margin
+    rgba = np.repeat(np.repeat(rgba, scale, axis=0), scale, axis=1)
+    if not electrodes:
+        return rgba
+
+    border = MARGIN * scale
+    image = np.zeros((rgba.shape[0] + 2 * border, rgba.shape[1] + 2 * border, 4), dtype=np.uint8)
+    image[border:-border, border:-border] = rgba
+
+    # Alpha composite the precomputed electrode layer over the image
+    overlay = electrode_overlay(ds.shape[0], scale)
+    alpha = overlay[..., 3:].astype(np.uint16)
+    image = (overlay * alpha + image * (255 - alpha) + 127) // 255
+    image[..., 3] = np.maximum(overlay[..., 3], image[..., 3])
+
+    return image.astype(np.uint8)
+
+
+def encode_png(rgba: np.ndarray, compress_level: int = 3):
+    """ Encode an RGBA uint8 array as PNG file contents using only the standard library
+
+    Parameters
+    ----------
+    rgba : np.ndarray
+        height x width x 4 uint8 array
+    compress_level : int, optional
+        zlib compression level, lower is faster, by default 3
+
+    Returns
+    -------
+    bytes
+        the contents of the PNG file
+    """
+
+    height, width = rgba.shape[:2]
+
+    # Every row starts with filter type 0 (none)
+    raw = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+    raw[:, 1:] = np.ascontiguousarray(rgba, dtype=np.uint8).reshape(height, width * 4)
+
+    def chunk(tag: bytes, data: bytes):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    return b"".join([
+        b"\x89PNG\r\n\x1a\n",
+        chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)),
+        chunk(b"IDAT", zlib.compress(raw.tobytes(), compress_level)),
+        chunk(b"IEND", b""),
+    ])
+
+
+def write_png(path: str, rgba: np.ndarray, compress_level: int = 3):
+    """ Write an RGBA uint8 array as a PNG file, see `encode_png` for the parameters """
+
+    with open(path, "wb") as file:
+        file.write(encode_png(rgba, compress_level))
+
+
+def export_png(path: str, ds: np.ndarray, vmin: float = None, vmax: float = None, scale: int = DEFAULT_SCALE,
+               electrodes: bool = True, cmap: str = "viridis"):
+    """ Write a reconstructed image as a colour mapped heatmap PNG, see `render_array` for the parameters """
+
+    with instrument.stage("export_png"):
+        write_png(path, render_array(ds, vmin=vmin, vmax=vmax, scale=scale, electrodes=electrodes, cmap=cmap))
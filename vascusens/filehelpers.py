@@ -1,4 +1,204 @@
-import pandas as pd
+import hashlib
+import os
+import threading
+import zipfile
+
+import numpy as np
+
+import instrument
+
+# Frequencies measured in every recording, one spreadsheet column each
+FREQUENCIES = range(20, 101)
+
+# Native binary recording format, an uncompressed .npz archive
+RECORDING_EXTENSION = ".npz"
+RECORDING_FORMAT_VERSION = 1
+
+# Number of recordings kept in memory by `load_recording`
+RECORDING_CACHE_SIZE = 16
+
+# Recordings read by `load_recording` by absolute path, with the modification time and size of the file they were read
+# from. Guarded by a lock as the GUI loads recordings from worker threads
+_recordings = {}
+_recordings_lock = threading.Lock()
+
+
+class Recording:
+    """ The impedance readings of one recording at every measured frequency
+
+    Parameters
+    ----------
+    data : np.ndarray
+        2D array of readings with one row per measurement and one column per frequency
+    frequencies : list[int], optional
+        the frequency of each column of `data`, by default 20 to 100 inclusive
+    path : str, optional
+        path string of the file the recording was read from, by default ""
+    n_el : int, optional
+        number of electrodes of the stent, by default 16
+    source_hash : str, optional
+        SHA-256 hash of the spreadsheet the recording was converted from, by default ""
+    """
+
+    def __init__(self, data: np.ndarray, frequencies=FREQUENCIES, path: str = "", n_el: int = 16,
+                 source_hash: str = ""):
+        self.data = np.asarray(data, dtype=np.float64)
+        self.frequencies = [int(freq) for freq in frequencies]
+        self.path = path
+        self.n_el = n_el
+        self.source_hash = source_hash
+
+        # Column of the data array for each frequency
+        self._columns = {freq: column for column, freq in enumerate(self.frequencies)}
+
+        if self.data.ndim != 2 or self.data.shape[1] != len(self.frequencies):
+            raise ValueError("Recording data must have one column per frequency, got an array of shape " +
+                             str(self.data.shape) + " for " + str(len(self.frequencies)) + " frequencies.")
+
+    @classmethod
+    def from_excel(cls, path: str):
+        """ Read a recording from the first sheet of an Excel spreadsheet (.xlsx) with a single parse
+
+        Parameters
+        ----------
+        path : str
+            path string of the spreadsheet, whose header row holds the frequencies
+
+        Returns
+        -------
+        Recording
+            the readings at every frequency in the spreadsheet
+        """
+
+        # Imported here as it is slow to import and not needed for converted recordings
+        import pandas as pd
+
+        with instrument.stage("load.xlsx", file=os.path.basename(path)):
+            file = pd.read_excel(path, sheet_name=None, engine="openpyxl")
+            spreadsheet = list(file.values())[0]
+
+        return cls(spreadsheet.to_numpy(dtype=np.float64), frequencies=spreadsheet.columns, path=path,
+                   source_hash=file_hash(path))
+
+    @classmethod
+    def from_npz(cls, path: str):
+        """ Read a recording stored in the native binary format by `Recording.save`
+
+        Parameters
+        ----------
+        path : str
+            path string of the .npz recording
+
+        Returns
+        -------
+        Recording
+            the readings at every frequency in the file
+        """
+
+        with instrument.stage("load.npz", file=os.path.basename(path)), np.load(path, allow_pickle=False) as file:
+            try:
+                version = int(file["format_version"])
+                if version > RECORDING_FORMAT_VERSION:
+                    raise ValueError("Recording '" + path + "' has format version " + str(version) + ", this " +
+                                     "version of VascuSens reads up to version " + str(RECORDING_FORMAT_VERSION))
+
+                return cls(file["data"], frequencies=file["frequencies"], path=path, n_el=int(file["n_el"]),
+                           source_hash=str(file["source_hash"]))
+            except KeyError:
+                raise ValueError("File '" + path + "' is not a VascuSens recording")
+
+    @classmethod
+    def load(cls, path: str):
+        """ Read a recording from either an Excel spreadsheet or the native binary format, chosen by extension """
+
+        if path.lower().endswith(RECORDING_EXTENSION):
+            return cls.from_npz(path)
+
+        return cls.from_excel(path)
+
+    def save(self, path: str):
+        """ Write the recording in the native binary format
+
+        The recording is written to a temporary file and renamed into place, so an interrupted write never leaves a
+        truncated recording at `path`.
+
+        Parameters
+        ----------
+        path : str
+            path string of the .npz file to write
+        """
+
+        tmp_path = path + ".tmp-" + str(os.getpid())
+
+        try:
+            # Write to a file object so numpy does not append a second extension
+            with open(tmp_path, "wb") as file:
+                np.savez(file, format_version=RECORDING_FORMAT_VERSION, data=self.data,
+                         frequencies=np.array(self.frequencies), n_el=self.n_el, source_hash=self.source_hash)
+
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def at_frequency(self, freq: int):
+        """ Return the readings at a given frequency
+
+        Parameters
+        ----------
+        freq : int
+            frequency for which to extract data
+
+        Returns
+        -------
+        list[float]
+            the readings at the given frequency
+        """
+
+        if freq not in self._columns:
+            raise ValueError("Frequency " + str(freq) + " is not in the recording")
+
+        return self.data[:, self._columns[freq]].tolist()
+
+
+def load_recording(path: str):
+    """ Read a recording like `Recording.load`, reusing the last read of the file while it is unchanged
+
+    A file is considered unchanged while its modification time and size are the same, so repeated loads of the same
+    file cost a single `os.stat`. The data of the returned recording is read-only as it is shared between callers.
+
+    Parameters
+    ----------
+    path : str
+        path string of the .xlsx or .npz recording
+
+    Returns
+    -------
+    Recording
+        the readings at every frequency in the file
+    """
+
+    key = os.path.abspath(path)
+    stat = os.stat(key)
+    version = (stat.st_mtime_ns, stat.st_size)
+
+    with _recordings_lock:
+        cached = _recordings.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+    recording = Recording.load(path)
+    recording.data.flags.writeable = False
+
+    with _recordings_lock:
+        # Drop the oldest recording once the cache is full
+        _recordings.pop(key, None)
+        if len(_recordings) >= RECORDING_CACHE_SIZE:
+            del _recordings[next(iter(_recordings))]
+        _recordings[key] = (version, recording)
+
+    return recording
 
 
 def open_file_at_frequency(input_path: str, freq: int, baseline_path: str = ""):
@@ -23,22 +223,24 @@ def open_file_at_frequency(input_path: str, freq: int, baseline_path: str = ""):
     if freq not in range(20, 101):
         raise ValueError("Please enter a whole number frequency between 20 and 100 inclusive")
 
-    # Open data file
+    # Open data file, a missing path is reported like an invalid one
+    if not input_path:
+        raise ValueError("Invalid file path. Input a valid file path string with \'-i [INPUT_PATH]\' and try again.\n")
+
     try:
-        file = pd.read_excel(input_path, sheet_name=None, engine="openpyxl")
+        recording = load_recording(input_path)
     except FileNotFoundError:
         raise FileNotFoundError("Input file at path '" + input_path + "' was not found.\n")
     except ValueError:
         raise ValueError("Invalid file path. Input a valid file path string with \'-i [INPUT_PATH]\' and try again.\n")
 
     # Extract input data at the frequency provided
-    spreadsheet = list(file.values())[0]
-    input_data = list(spreadsheet[freq])
+    input_data = recording.at_frequency(freq)
 
     # Open baseline data file if provided
-    if baseline_path != "":
+    if baseline_path:
         try:
-            file = pd.read_excel(baseline_path, sheet_name=None, engine="openpyxl")
+            recording = load_recording(baseline_path)
         except FileNotFoundError:
             raise FileNotFoundError("Baseline file at path '" + baseline_path + "' was not found.")
         except ValueError:
@@ -46,9 +248,91 @@ def open_file_at_frequency(input_path: str, freq: int, baseline_path: str = ""):
                              "again.\n")
 
         # Extract data or set it as None if no data was provided
-        spreadsheet = list(file.values())[0]
-        baseline_data = list(spreadsheet[freq])
+        baseline_data = recording.at_frequency(freq)
     else:
         baseline_data = None
 
     return input_data, baseline_data
+
+
+def is_converted(recording_path: str, spreadsheet_path: str):
+    """ Return whether a converted recording holds the current contents of the spreadsheet it was converted from
+
+    Parameters
+    ----------
+    recording_path : str
+        path string of the converted .npz recording
+    spreadsheet_path : str
+        path string of the .xlsx spreadsheet
+
+    Returns
+    -------
+    bool
+        `False` if the spreadsheet changed since the conversion, or the recording is missing, truncated, corrupt or
+        was converted by an incompatible version
+    """
+
+    try:
+        return Recording.from_npz(recording_path).source_hash == file_hash(spreadsheet_path)
+    except (ValueError, OSError, EOFError, zipfile.BadZipFile):
+        return False
+
+
+def file_hash(path: str):
+    """ Return the SHA-256 hex digest of a file's contents """
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def convert_directory(source: str, output_dir: str = None):
+    """ Convert the .xlsx recordings in a directory tree to the native binary format
+
+    Recordings that were already converted from an unchanged spreadsheet are skipped.
+
+    Parameters
+    ----------
+    source : str
+        path string of a directory of .xlsx files, searched recursively, or of a single .xlsx file
+    output_dir : str, optional
+        directory to write the .npz files to, mirroring the layout of `source`, by default next to each spreadsheet
+
+    Returns
+    -------
+    list[str]
+        path strings of the .npz files that were written
+    """
+
+    # Collect the spreadsheets to convert, relative to the source directory
+    if os.path.isfile(source):
+        source_dir = os.path.dirname(source)
+        spreadsheets = [os.path.basename(source)]
+    elif os.path.isdir(source):
+        source_dir = source
+        spreadsheets = sorted(
+            os.path.relpath(os.path.join(root, name), source)
+            for root, _, names in os.walk(source)
+            for name in names
+            if name.lower().endswith(".xlsx") and not name.startswith("~$")
+        )
+    else:
+        raise FileNotFoundError("Source path '" + source + "' was not found.")
+
+    written = []
+    for spreadsheet in spreadsheets:
+        input_path = os.path.join(source_dir, spreadsheet)
+        output_path = os.path.join(output_dir or source_dir, os.path.splitext(spreadsheet)[0] + RECORDING_EXTENSION)
+
+        # Skip spreadsheets whose conversion is up to date
+        if os.path.exists(output_path) and is_converted(output_path, input_path):
+            continue
+
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        Recording.from_excel(input_path).save(output_path)
+        written.append(output_path)
+
+    return written
@@ -1,19 +1,110 @@
+import os
 import tkinter as tk
 import webbrowser
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from tkinter import StringVar, filedialog, messagebox, ttk
 
 import matplotlib
 import openpyxl
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from filehelpers import open_file_at_frequency
+import numpy as np
+from matplotlib.figure import Figure
 
-from visualisation import greit_visualisation
+import instrument
+from filehelpers import FREQUENCIES, load_recording, open_file_at_frequency
+
+from reconstruction import DEFAULT_PRESET, PRESETS, preset_engine, reconstruct, reconstruct_sweep
+from visualisation import ReconstructionFigure
 
 
 BUTTON1_DEFAULT_TEXT = "1. No Item Selected"
 BUTTON2_DEFAULT_TEXT = "2. No Item Selected"
 BASELINE_DEFAULT_TEXT = "None Set"
 
+# Milliseconds between checks for finished reconstructions
+POLL_INTERVAL = 50
+
+# Milliseconds after the last change of the flatten settings before the visualisations are refreshed
+REFRESH_DELAY = 300
+
+# Resolution of the frequency preview, which is coarse so scrubbing the slider stays fast, and of saved images
+SWEEP_PRESET = "preview"
+SAVE_PRESET = "diagnostic"
+
+
+def compute_visualisation(input_path, freq, baseline_path, flatten, preset=DEFAULT_PRESET):
+    """
+    Opens the data and reconstructs it. Runs on a worker thread so it must not touch any Tk widgets.
+
+    Parameters
+    ----------
+    input_path : String
+        The file path from which to create the visualisation from.
+    freq : int
+        The frequency to use for the visualisation.
+    baseline_path : String
+        The file path of the baseline data, or "" for no baseline.
+    flatten : float
+        The number of standard deviations to flatten high values to, or None to not flatten.
+    preset : String
+        The resolution of the reconstruction, one of reconstruction.PRESETS.
+
+    Returns
+    -------
+    reconstruction.Reconstruction
+        The reconstruction to show.
+    """
+
+    with instrument.stage("visualisation", file=os.path.basename(input_path), freq=freq, preset=preset):
+        input_data, baseline_data = open_file_at_frequency(input_path, baseline_path=baseline_path, freq=freq)
+
+        return reconstruct(input_data, baseline_data, flatten, engine=preset_engine(preset))
+
+
+def save_visualisation(path, input_path, freq, baseline_path, flatten):
+    """
+    Reconstructs the data at the resolution of saved images and saves its figure. Runs on a worker thread so it must
+    not touch any Tk widgets.
+
+    Parameters
+    ----------
+    path : String
+        The file path to save the figure to.
+    input_path, freq, baseline_path, flatten
+        The data to reconstruct, as for compute_visualisation.
+    """
+
+    result = compute_visualisation(input_path, freq, baseline_path, flatten, preset=SAVE_PRESET)
+    ReconstructionFigure(result.ds, result.electrodes, fig=Figure(constrained_layout=True)).savefig(path)
+
+
+def compute_sweep(input_path, baseline_path, flatten):
+    """
+    Reconstructs the data at every frequency for the live frequency preview. Runs on a worker thread so it must not
+    touch any Tk widgets.
+
+    Parameters
+    ----------
+    input_path : String
+        The file path from which to create the visualisations from.
+    baseline_path : String
+        The file path of the baseline data, or "" for no baseline.
+    flatten : float
+        The number of standard deviations to flatten high values to, or None to not flatten.
+
+    Returns
+    -------
+    np.ndarray
+        The reconstructed image at each frequency in FREQUENCIES.
+    """
+
+    with instrument.stage("sweep", file=os.path.basename(input_path)):
+        recording = load_recording(input_path)
+        baseline = load_recording(baseline_path) if baseline_path else None
+
+        return reconstruct_sweep(recording, baseline, flatten=flatten, engine=preset_engine(SWEEP_PRESET))
+
 
 class VascuSensGUI:
 
@@ -27,6 +118,24 @@ class VascuSensGUI:
         # Place widgets and define layout for window object
         self.setup_layout()
 
+        # Reconstructions run on worker threads so the window stays responsive. The pending job of each
+        # visualisation panel is kept until its result is shown, or dropped when the settings change
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        self.jobs = {}
+        self.jobs_total = 0
+        self.polling = False
+
+        # The reconstructions of each panel at every frequency, computed after its first visualisation so the
+        # frequency slider can swap images without reconstructing
+        self.sweeps = {}
+
+        # The data shown in each panel, re-rendered at a finer resolution when saved, and the pending saves
+        self.sources = {}
+        self.saves = []
+
+        # Pending refresh of the visualisations after the flatten settings or the baseline changed
+        self.refresh_id = None
+
     def configure_window(self):
         """ Configuration of the TK window object """
 
@@ -160,8 +269,12 @@ class VascuSensGUI:
         )
         self.flatten_checkbutton.grid(row=6, column=2, columnspan=1)
 
-        # Add vertical space between the certain sections
-        side_controls.grid_rowconfigure(7, minsize=15)
+        # Resolution of generated visualisations, the frequency preview is always coarse and saved images are fine
+        ttk.Label(side_controls, text="Quality: ").grid(row=7, column=0, pady=(10, 0))
+        self.quality_stringvar = StringVar()
+        self.quality_stringvar.set(DEFAULT_PRESET)
+        ttk.Combobox(side_controls, textvariable=self.quality_stringvar, values=list(PRESETS), state="readonly",
+                     width=12).grid(row=7, column=1, sticky="we", padx=5, pady=(10, 0))
 
         # Define and place two buttons for the user to reset the visualisations
         reset_vis1 = ttk.Button(side_controls, text="Reset V. 1", command=self.reset_left)
@@ -170,11 +283,31 @@ class VascuSensGUI:
         reset_vis2 = ttk.Button(side_controls, text="Reset V. 2", command=self.reset_right)
         reset_vis2.grid(row=8, column=1, columnspan=2, sticky="e", ipadx=20)
 
+        # Progress of the reconstructions running in the background
+        self.status_stringvar = StringVar()
+        self.status_stringvar.set("Ready")
+        self.progress = ttk.Progressbar(side_controls, mode="indeterminate")
+        self.progress.grid(row=9, column=0, columnspan=3, sticky="we", pady=(15, 0))
+        tk.Label(side_controls, textvariable=self.status_stringvar).grid(row=10, column=0, columnspan=3)
+
+        # Moving the slider previews the frequency, results generated with outdated settings are discarded and the
+        # visualisations shown are refreshed with the new flatten settings
+        self.slider_value.trace_add("write", lambda *args: self.preview_frequency())
+        for variable in (self.f_std_val, self.f_bool):
+            variable.trace_add("write", lambda *args: self.settings_changed())
+        self.quality_stringvar.trace_add("write", lambda *args: self.cancel_jobs(sweeps=False))
+
         # Create the generate button for the visualisation
         generate_button = tk.Button(self.window, text="Generate...", font=("Ubuntu", 20),
                                     command=self.generate, fg="green")
         generate_button.grid(row=8, column=0, ipady=25, columnspan=4, sticky="we")
 
+        # Status bar with the time taken by each stage of the last visualisation, when instrumentation is enabled
+        self.trace_stringvar = StringVar()
+        if instrument.enabled():
+            tk.Label(self.window, textvariable=self.trace_stringvar, anchor="w", relief="sunken",
+                     font="Ubuntu 9").grid(row=9, column=0, columnspan=4, sticky="we")
+
         # Placeholder for the left-side visualisation object
         self.visualisation_placeholder1 = tk.Canvas(self.window, bg="#98B4D4")
         self.visualisation_placeholder1.create_text(
@@ -208,6 +341,9 @@ class VascuSensGUI:
         self.options1 = tk.Frame(self.window)
         self.options2 = tk.Frame(self.window)
 
+        # The figure and canvas of each visualisation panel, created on their first visualisation and then reused
+        self.panels = {}
+
         # Define an empty baseline path until it is set
         self.baseline_path = BASELINE_DEFAULT_TEXT
 
@@ -304,7 +440,8 @@ class VascuSensGUI:
         flatten_std,
     ):
         """
-        Handles the creation of the visualisations. Only generates one visualisation at a time.
+        Handles the creation of the visualisations. Only generates one visualisation at a time. The reconstruction
+        is queued on a worker thread and shown by poll_jobs once it finishes.
 
         Parameters
         ----------
@@ -319,72 +456,304 @@ class VascuSensGUI:
             If this variable is true, it will delete the second visualisation
             placeholder for the generated visualisation.
         flatten : boolean
-            This variable is a value specified in the GUI for use in the greit_visualisation function.
+            This variable is a value specified in the GUI for use in the reconstruct function.
         flatten_std : float
-            This variable is a value specified in the GUI for use in the greit_visualisation function.
+            This variable is a value specified in the GUI for use in the reconstruct function.
         """
 
-        # Open input and baseline data files
-        if self.baseline_path != BASELINE_DEFAULT_TEXT:
-            input_data, baseline_data = open_file_at_frequency(input_path, baseline_path=self.baseline_path, freq=freq)
+        # Use the baseline file only if one has been set
+        baseline_path = self.baseline_path if self.baseline_path != BASELINE_DEFAULT_TEXT else ""
+
+        # Check which visualisation we are replacing. Elif is acceptable here as this function only generates one
+        # visualisation at a time
+        if forget_vis1:
+            side = 1
+        elif forget_vis2:
+            side = 2
         else:
-            input_data, baseline_data = open_file_at_frequency(input_path, freq=freq)
+            return
+
+        # Show the frequency straight away if it has already been reconstructed with the same settings
+        flatten = flatten_std if flatten else None
+        settings = (input_path, baseline_path, flatten)
+        preset = self.quality_stringvar.get()
+        self.sources[side] = (input_path, freq, baseline_path, flatten)
+        sweep = self.sweeps.get(side)
+        if sweep is not None and sweep["settings"] == settings and "images" in sweep and preset == SWEEP_PRESET:
+            self.show_visualisation(side, sweep["images"][FREQUENCIES.index(freq)], clim=sweep["clim"])
+            return
+
+        # Queue the reconstruction, replacing any pending job of the same panel
+        self.jobs[side] = self.executor.submit(compute_visualisation, input_path, freq, baseline_path, flatten, preset)
+        self.jobs_total += 1
 
-        # Generate the visualisation
-        if flatten:
-            fig = greit_visualisation(input_data, baseline_data, flatten_std)
+        # Queue the reconstruction at every frequency for the slider preview, unless it is already pending
+        if sweep is None or sweep["settings"] != settings:
+            self.sweeps[side] = {"settings": settings, "job": self.executor.submit(compute_sweep, *settings)}
+
+        self.update_status()
+        self.start_polling()
+
+    def start_polling(self):
+        """ Starts checking for finished reconstructions from the Tk main loop """
+
+        if not self.polling:
+            self.polling = True
+            self.window.after(POLL_INTERVAL, self.poll_jobs)
+
+    def poll_jobs(self):
+        """ Shows the results of finished reconstructions. Runs on the Tk main loop until no jobs are pending """
+
+        for side, job in list(self.jobs.items()):
+            if not job.done():
+                continue
+
+            del self.jobs[side]
+            if job.cancelled():
+                continue
+
+            error = job.exception()
+            if error is not None:
+                messagebox.showerror("Error", "Visualisation " + str(side) + " could not be generated.\n" + str(error))
+            else:
+                result = job.result()
+                self.show_visualisation(side, result.ds, result.electrodes)
+                self.show_trace("visualisation")
+
+        for side, sweep in list(self.sweeps.items()):
+            if "images" in sweep or not sweep["job"].done():
+                continue
+
+            # Errors were already reported by the visualisation of the same settings
+            if sweep["job"].cancelled() or sweep["job"].exception() is not None:
+                del self.sweeps[side]
+                continue
+
+            # Colour every frequency on the same scale so the slider only has to redraw the image
+            sweep["images"] = sweep["job"].result()
+            sweep["clim"] = (np.nanmin(sweep["images"]), np.nanmax(sweep["images"]))
+
+            # The sweep supersedes a single frequency visualisation of the same resolution, but not a finer one,
+            # which it only stands in for while the panel shows nothing
+            sweep_quality = self.quality_stringvar.get() == SWEEP_PRESET
+            if side in self.jobs and sweep_quality:
+                self.jobs.pop(side).cancel()
+            if side not in self.jobs and (sweep_quality or side not in self.panels):
+                self.preview_frequency(side)
+            self.show_trace("sweep")
+
+        for path, job in list(self.saves):
+            if not job.done():
+                continue
+
+            self.saves.remove((path, job))
+            if job.exception() is not None:
+                messagebox.showerror("Error", "Visualisation could not be saved.\n" + str(job.exception()))
+            else:
+                self.show_trace("visualisation")
+
+        self.update_status()
+
+        # Keep polling while there are pending jobs
+        if self.jobs or self.pending_sweeps() or self.saves:
+            self.window.after(POLL_INTERVAL, self.poll_jobs)
         else:
-            fig = greit_visualisation(input_data, baseline_data)
+            self.polling = False
 
-        # Check which visualisation we are replacing
-        if forget_vis1:
-            # Remove the visualisation placeholder from grid
-            self.visualisation_placeholder1.grid_forget()
-            # Place our visualisation actual holder
-            self.left_vis_frame.grid(row=2, column=2, rowspan=5, sticky="we")
+    def show_trace(self, name):
+        """
+        Shows the time taken by each stage of the last run in the status bar, when instrumentation is enabled.
 
-            # Draw our generated visualisation to grid
-            visual1 = FigureCanvasTkAgg(fig, self.left_vis_frame)
-            visual1.draw()
-            self.options1.grid(row=7, column=2)
+        Parameters
+        ----------
+        name : String
+            The name of the instrumented stage that ran on the worker thread.
+        """
 
-            # Add a save button for the visualisation
-            ttk.Button(
-                self.options1, text="Save Visualisation", command=lambda: self.save_vis(fig), width=45
-            ).grid(row=0, column=0)
+        if not instrument.enabled():
+            return
 
-            # Place our visualisation in holder
-            visual1 = visual1.get_tk_widget().grid(row=0, column=0)
+        runs = [instrument.last_run(name), instrument.last_run("figure.create"), instrument.last_run("figure.update")]
+        runs = [run for run in runs if run is not None]
 
-        # Elif is acceptable here as this function only generates one visualisation at a time
-        elif forget_vis2:
-            # Remove the 2nd visualisation placeholder from grid
-            self.visualisation_placeholder2.grid_forget()
+        # The most recent rendering of the figure, which runs after the reconstruction
+        text = instrument.format_run(runs[0]) if runs and runs[0]["name"] == name else ""
+        rendering = [run for run in runs if run["name"] != name]
+        if rendering:
+            text += " | " + instrument.format_run(max(rendering, key=lambda run: run["start"]))
+
+        self.trace_stringvar.set("Last run: " + text)
 
-            # Place our actual frame holder for the visualisation
-            self.right_vis_frame.grid(row=2, column=3, rowspan=5, sticky="we", padx=10)
+    def pending_sweeps(self):
+        """ Returns the panels whose reconstructions at every frequency are not finished yet """
 
-            # Draw our visualisation to grid
-            visual2 = FigureCanvasTkAgg(fig, self.right_vis_frame)
-            visual2.draw()
-            self.options2.grid(row=7, column=3)
+        return [side for side, sweep in self.sweeps.items() if "images" not in sweep]
+
+    def preview_frequency(self, side=None):
+        """
+        Shows the slider frequency in the visualisation panels from their reconstructions at every frequency. Called
+        by tkinter when the user slides the slider for frequency selection.
+
+        Parameters
+        ----------
+        side : int, optional
+            1: only update the left visualisation panel, 2: only update the right visualisation panel. By default
+            both panels are updated.
+        """
+
+        # Pending visualisations are for the previous frequency
+        if side is None:
+            self.cancel_jobs(sweeps=False)
+
+        freq = self.get_slider_value()
+        for panel, sweep in self.sweeps.items():
+            if "images" in sweep and side in (None, panel):
+                self.show_visualisation(panel, sweep["images"][FREQUENCIES.index(freq)], clim=sweep["clim"])
+
+                input_path, baseline_path, flatten = sweep["settings"]
+                self.sources[panel] = (input_path, freq, baseline_path, flatten)
+
+    def cancel_jobs(self, sweeps=True):
+        """
+        Cancels pending reconstructions. Jobs that have already started finish, but their results are ignored.
+
+        Parameters
+        ----------
+        sweeps : boolean
+            By default this is true, if this is set to false the pending reconstructions at every frequency are kept.
+        """
+
+        for job in self.jobs.values():
+            job.cancel()
+
+        self.jobs.clear()
+
+        # Finished sweeps match the visualisations shown, so the slider keeps working with them
+        if sweeps:
+            for side in self.pending_sweeps():
+                self.sweeps.pop(side)["job"].cancel()
+
+        self.update_status()
+
+    def settings_changed(self):
+        """ Drops the reconstructions with outdated settings and refreshes the visualisations shortly after the last
+        change, so typing a flatten value only reconstructs once """
+
+        self.cancel_jobs()
+
+        if self.refresh_id is not None:
+            self.window.after_cancel(self.refresh_id)
+        self.refresh_id = self.window.after(REFRESH_DELAY, self.refresh_visualisations)
+
+    def refresh_visualisations(self):
+        """
+        Reconstructs the visualisations shown with the current flatten settings and baseline. Only the stages after the
+        changed setting run again, as the reconstruction pipeline memoises the earlier ones.
+        """
+
+        self.refresh_id = None
+
+        # Wait for a valid flatten value, errors are only reported when the user clicks Generate
+        try:
+            flatten_std = float(self.f_std.get())
+        except ValueError:
+            return
+        if flatten_std < 0:
+            return
+
+        for side, (input_path, _, _, _) in list(self.sources.items()):
+            self.visualisation(input_path, self.get_slider_value(), side == 1, side == 2, self.f_bool.get(),
+                               flatten_std)
+
+    def update_status(self):
+        """ Shows the progress of the pending reconstructions below the side controls """
+
+        if self.jobs:
+            done = self.jobs_total - len(self.jobs)
+            self.status_stringvar.set("Generating... (" + str(done) + " of " + str(self.jobs_total) + " done)")
+            self.progress.start()
+        elif self.pending_sweeps():
+            self.status_stringvar.set("Preparing the frequency preview...")
+            self.progress.start()
+        elif self.saves:
+            self.status_stringvar.set("Saving at " + SAVE_PRESET + " quality...")
+            self.progress.start()
+        else:
+            self.jobs_total = 0
+            self.status_stringvar.set("Ready")
+            self.progress.stop()
+
+    def show_visualisation(self, side, ds, electrodes=None, clim=None):
+        """
+        Shows a reconstruction in one of the visualisation panels. Each panel creates its figure, canvas and save
+        button once, later reconstructions only replace the image data of the figure.
+
+        Parameters
+        ----------
+        side : int
+            1: the left visualisation panel, 2: the right visualisation panel.
+        ds : np.ndarray
+            The reconstructed image to show.
+        electrodes : np.ndarray, optional
+            The positions of the electrodes in pixel coordinates, by default evenly spaced around the image.
+        clim : tuple, optional
+            The values mapped to the ends of the colour map, by default the image minimum and maximum.
+        """
+
+        if side == 1:
+            placeholder, vis_frame, options = self.visualisation_placeholder1, self.left_vis_frame, self.options1
+        else:
+            placeholder, vis_frame, options = self.visualisation_placeholder2, self.right_vis_frame, self.options2
+
+        # Images of another resolution need a new figure
+        panel = self.panels.get(side)
+        if panel is not None and panel["figure"].im.get_array().shape != np.shape(ds):
+            panel["canvas"].get_tk_widget().destroy()
+            panel["button"].destroy()
+            panel = None
+
+        if panel is None:
+            # Create the figure outside of pyplot so it is only referenced by this panel
+            figure = ReconstructionFigure(ds, electrodes, fig=Figure(constrained_layout=True))
+            if clim is not None:
+                figure.update(ds, clim)
+
+            # Draw our generated visualisation to its holder
+            canvas = FigureCanvasTkAgg(figure.fig, vis_frame)
+            figure.connect(canvas)
+            canvas.draw()
+            canvas.get_tk_widget().grid(row=0, column=0)
 
             # Add a save button for the visualisation
-            ttk.Button(
-                self.options2, text="Save Visualisation", command=lambda: self.save_vis(fig), width=45
-            ).grid(row=0, column=0)
+            button = ttk.Button(options, text="Save Visualisation", command=lambda: self.save_vis(side, figure),
+                                width=45)
+            button.grid(row=0, column=0)
 
-            # Place our visualisation in holder
-            visual2 = visual2.get_tk_widget().grid(row=0, column=0)
+            self.panels[side] = {"figure": figure, "canvas": canvas, "button": button}
+        else:
+            # Update the image of the existing figure
+            panel["figure"].update(ds, clim)
+
+        # Remove the visualisation placeholder from grid and place our visualisation holders
+        placeholder.grid_forget()
+        if side == 1:
+            vis_frame.grid(row=2, column=2, rowspan=5, sticky="we")
+            options.grid(row=7, column=2)
+        else:
+            vis_frame.grid(row=2, column=3, rowspan=5, sticky="we", padx=10)
+            options.grid(row=7, column=3)
 
-    def save_vis(self, fig):
+    def save_vis(self, side, figure):
         """
-        Handles the saving of the visualisations.
+        Handles the saving of the visualisations. The data shown is reconstructed again at the resolution of saved
+        images on a worker thread, and saved by it.
 
         Parameters
         ----------
-        fig : matplotlib.figure.Figure
-            The matplotlib figure to be saved
+        side : int
+            1: the left visualisation panel, 2: the right visualisation panel.
+        figure : visualisation.ReconstructionFigure
+            The figure shown, saved as it is if the data it shows is unknown.
         """
 
         # Tk dialog to ask where to save the file. Allows for jpg, png and svg format but png by default
@@ -397,13 +766,25 @@ class VascuSensGUI:
             ),
         )
 
-        # Write to file and save
-        fig.savefig(path)
+        # Write to file and save, unless the user cancelled the dialog
+        if not path:
+            return
+
+        if side not in self.sources:
+            figure.savefig(path)
+            return
+
+        self.saves.append((path, self.executor.submit(save_visualisation, path, *self.sources[side])))
+        self.update_status()
+        self.start_polling()
 
     def generate(self):
         """ This function coordinates all the data ready for visualisation. Called when the user clicks the Generate
         button """
 
+        # Drop the reconstructions of any previous click, their settings are outdated
+        self.cancel_jobs(sweeps=False)
+
         # Perform validation on the configurations the user has set. If 0 is returned we know there is errors
         if(self.perform_validation() == 0):
             # Exit function as there is errors. No need for error message as it is handled in performValidation()
@@ -477,28 +858,28 @@ class VascuSensGUI:
         # If the first file has been set, check it is a file
         if self.button1_stringvar.get() != BUTTON1_DEFAULT_TEXT:
             try:
-                openpyxl.load_workbook(self.button1_stringvar_path.get())
+                self.check_file(self.button1_stringvar_path.get())
             except openpyxl.utils.exceptions.InvalidFileException:
                 # Not a valid file, throw an error
-                messagebox.showerror("Error", "File 1 is not an Excel File")
+                messagebox.showerror("Error", "File 1 is not an Excel File or a converted recording")
                 return 0
 
         # If the second file has been set, check it is a file
         if self.button2_stringvar.get() != BUTTON2_DEFAULT_TEXT:
             try:
-                openpyxl.load_workbook(self.button2_stringvar_path.get())
+                self.check_file(self.button2_stringvar_path.get())
             except openpyxl.utils.exceptions.InvalidFileException:
                 # Not a valid file, throw an error
-                messagebox.showerror("Error", "File 2 is not an Excel File")
+                messagebox.showerror("Error", "File 2 is not an Excel File or a converted recording")
                 return 0
 
         # Check that baseline_path is valid
         if self.baseline_path != "None Set":
             try:
-                openpyxl.load_workbook(self.baseline_path)
+                self.check_file(self.baseline_path)
             except openpyxl.utils.exceptions.InvalidFileException:
                 # Not a valid file, throw an error
-                messagebox.showerror("Error", "Baseline file is not an Excel File")
+                messagebox.showerror("Error", "Baseline file is not an Excel File or a converted recording")
                 return 0
 
         # Check that flatten is a float value
@@ -522,6 +903,28 @@ class VascuSensGUI:
         # If program has got to this point there are no errors, return a 1
         return 1
 
+    def check_file(self, path):
+        """
+        Checks that a file is an Excel file or a recording converted to the native binary format. The file is read
+        with load_recording, so the visualisation reuses this read instead of parsing the file again.
+
+        Parameters
+        ----------
+        path : String
+            The path of the file to check.
+
+        Raises
+        ------
+        openpyxl.utils.exceptions.InvalidFileException
+            If the file is neither an Excel file nor a converted recording.
+        """
+
+        # Reading the recording checks its format and data
+        try:
+            load_recording(path)
+        except (ValueError, zipfile.BadZipFile) as error:
+            raise openpyxl.utils.exceptions.InvalidFileException(str(error))
+
     def clear_file1(self):
         """ Used to clear the set data for file1. Called from the edit menu popup when editing a file """
 
@@ -734,19 +1137,14 @@ class VascuSensGUI:
     def reset_left(self):
         """ Reset any produced visualisations on the left side and reinstate the visualisation placeholder """
 
+        # Stop reconstructing for this panel
+        self.forget_panel_jobs(1)
+
         # Forget actual visualisation holders from UI
         self.options1.grid_forget()
         self.left_vis_frame.grid_forget()
 
         # Reinstate visualisation placeholder to stop column collapsing
-        self.visualisation_placeholder1 = tk.Canvas(self.window, bg="#98B4D4")
-        self.visualisation_placeholder1.create_text(
-            150,
-            10,
-            fill="darkblue",
-            font="Times 10 italic bold",
-            text="EMPTY VISUALISATION OBJECT",
-        )
         self.visualisation_placeholder1.grid(
             row=2,
             column=2,
@@ -757,23 +1155,29 @@ class VascuSensGUI:
     def reset_right(self):
         """ Reset any produced visualisations on the right side and reinstate the visualisation placeholder """
 
+        # Stop reconstructing for this panel
+        self.forget_panel_jobs(2)
+
         # Forget actual-visualisation holders from UI
         self.options2.grid_forget()
         self.right_vis_frame.grid_forget()
 
         # Reinstate visualisation placeholder to stop column collapsing
-        self.visualisation_placeholder2 = tk.Canvas(self.window, bg="#98B4D4")
-        self.visualisation_placeholder2.create_text(
-            150,
-            10,
-            fill="darkblue",
-            font="Times 10 italic bold",
-            text="EMPTY VISUALISATION OBJECT.",
-        )
         self.visualisation_placeholder2.grid(
             row=2, column=3, rowspan=5, sticky="nswe", padx=(0, 10)
         )
 
+    def forget_panel_jobs(self, side):
+        """ Cancels the pending reconstructions of one visualisation panel and drops its frequency preview """
+
+        if side in self.jobs:
+            self.jobs.pop(side).cancel()
+        if side in self.sweeps:
+            self.sweeps.pop(side)["job"].cancel()
+        self.sources.pop(side, None)
+
+        self.update_status()
+
     def edit_baseline_path(self):
         """ Handle the changing of configurations for the baseline file data path by producing a pop-up box """
 
@@ -821,7 +1225,10 @@ class VascuSensGUI:
             # Change baseline path variable
             self.baseline_path = newpath[0]
         except IndexError:
-            pass
+            return
+
+        # Results reconstructed with the previous baseline are outdated
+        self.settings_changed()
 
 
 def main():
@@ -829,6 +1236,9 @@ def main():
     program = VascuSensGUI()
     program.window.mainloop()
 
+    # Do not wait for reconstructions that have not started yet
+    program.executor.shutdown(wait=False, cancel_futures=True)
+
 
 if __name__ == "__main__":
     main()
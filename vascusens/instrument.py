@@ -0,0 +1,257 @@
+import atexit
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import deque
+
+# Environment variable enabling the instrumentation: "1" or "log" for one JSON line per stage on stderr, a path string
+# ending in ".json" for a Chrome trace (chrome://tracing or https://ui.perfetto.dev) written when the program exits,
+# or any other path string for JSON lines appended to that file
+TRACE_ENV = "VASCUSENS_TRACE"
+
+# Number of stages kept for the Chrome trace, the oldest are dropped first
+MAX_RECORDS = 100000
+
+# No-op context returned by `stage` while the instrumentation is disabled
+_DISABLED = contextlib.nullcontext()
+
+_sink = None
+_sink_pid = None
+_records = deque(maxlen=MAX_RECORDS)
+_last_runs = {}
+_lock = threading.Lock()
+_local = threading.local()
+_active = {}
+_overlaps = 0
+_origin = time.perf_counter()
+
+
+def enable(sink: str = "log"):
+    """ Start recording the wall time, CPU time and peak allocation of every stage
+
+    Parameters
+    ----------
+    sink : str, optional
+        "log" for one JSON line per stage on stderr, a path string ending in ".json" for a Chrome trace written when
+        the program exits, or any other path string for JSON lines appended to that file, by default "log"
+    """
+
+    global _sink, _sink_pid
+
+    if _sink is None and sink.endswith(".json"):
+        atexit.register(flush)
+
+    _sink = "log" if sink in ("1", "log") else sink
+    _sink_pid = os.getpid()
+
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def enabled():
+    """ Return whether stages are being recorded """
+
+    return _sink is not None
+
+
+def stage(name: str, **args):
+    """ Record the wall time, CPU time and peak allocation of a block of code
+
+    Used as `with instrument.stage("name"):`. Does nothing while the instrumentation is disabled. The CPU time is that
+    of the calling thread, and the peak allocation is that of the whole process while the stage runs, relative to its
+    allocated memory when the stage starts. The tracemalloc peak is shared by all threads and reset by every stage,
+    so the peak of a stage that ran while another thread was in a stage, e.g. a GUI worker, is not recorded (`None`).
+
+    Parameters
+    ----------
+    name : str
+        name of the stage
+    **args
+        details of the stage recorded with it, e.g. a file name
+    """
+
+    if _sink is None:
+        return _DISABLED
+
+    return _Stage(name, args)
+
+
+class _Stage:
+    """ Context manager recording one stage, see `stage` """
+
+    def __init__(self, name: str, args: dict):
+        self.name = name
+        self.args = args
+        self.children = []
+
+    def __enter__(self):
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = []
+
+        # The peak is reset for this stage, so the enclosing stage keeps the peak it has seen so far
+        current, peak = tracemalloc.get_traced_memory()
+        if stack:
+            stack[-1].max_peak = max(stack[-1].max_peak, peak)
+        tracemalloc.reset_peak()
+
+        # Stages running in other threads reset the peak too, which makes the peaks of both unreliable
+        global _overlaps
+        thread = threading.get_ident()
+        with _lock:
+            self.shared = any(other != thread for other in _active)
+            _overlaps += self.shared
+            self.overlaps = _overlaps
+            _active[thread] = _active.get(thread, 0) + 1
+
+        stack.append(self)
+        self.start_memory = current
+        self.max_peak = current
+        self.start = time.perf_counter()
+        self.start_cpu = time.thread_time()
+
+        return self
+
+    def __exit__(self, *exc_info):
+        wall = time.perf_counter() - self.start
+        cpu = time.thread_time() - self.start_cpu
+        peak = max(self.max_peak, tracemalloc.get_traced_memory()[1])
+
+        thread = threading.get_ident()
+        with _lock:
+            shared = self.shared or _overlaps != self.overlaps
+            _active[thread] -= 1
+            if not _active[thread]:
+                del _active[thread]
+
+        stack = _local.stack
+        stack.pop()
+        if stack:
+            stack[-1].max_peak = max(stack[-1].max_peak, peak)
+
+        record = {
+            "name": self.name,
+            "start": self.start - _origin,
+            "wall": wall,
+            "cpu": cpu,
+            "peak": None if shared else peak - self.start_memory,
+            "thread": threading.current_thread().name,
+            "tid": threading.get_ident(),
+            "args": self.args,
+            "children": self.children,
+        }
+
+        if stack:
+            stack[-1].children.append(record)
+        else:
+            with _lock:
+                _last_runs[self.name] = record
+
+        with _lock:
+            _records.append(record)
+
+        _emit(record)
+
+        return False
+
+
+def _emit(record: dict):
+    """ Write a finished stage to the log sink """
+
+    if _sink == "log" or not _sink.endswith(".json"):
+        line = json.dumps({
+            "stage": record["name"],
+            "wall_ms": round(record["wall"] * 1000, 3),
+            "cpu_ms": round(record["cpu"] * 1000, 3),
+            "peak_kb": None if record["peak"] is None else round(record["peak"] / 1024, 1),
+            "thread": record["thread"],
+            **record["args"],
+        }, default=str)
+
+        if _sink == "log":
+            print(line, file=sys.stderr, flush=True)
+        else:
+            with _lock, open(_sink, "a") as file:
+                file.write(line + "\n")
+
+
+def last_run(name: str):
+    """ Return the record of the last finished outermost stage with the given name, or `None`
+
+    The record holds the `name`, `wall` and `cpu` time in seconds, `peak` allocation in bytes, or `None` if another
+    thread was in a stage at the same time, `args` and the records of its nested stages in `children`.
+    """
+
+    with _lock:
+        return _last_runs.get(name)
+
+
+def format_run(record: dict):
+    """ Describe a stage and its nested stages in one line, e.g. "visualisation 52 ms (load 45 ms, solve 7 ms)" """
+
+    def describe(stage_record):
+        return stage_record["name"] + " " + format(stage_record["wall"] * 1000, ".3g") + " ms"
+
+    text = describe(record)
+    if record["peak"] is not None:
+        text += ", peak " + format(record["peak"] / 1024 / 1024, ".3g") + " MB"
+    if record["children"]:
+        text += " (" + ", ".join(describe(child) for child in record["children"]) + ")"
+
+    return text
+
+
+def chrome_trace():
+    """ Return the recorded stages in the Chrome trace event format """
+
+    with _lock:
+        records = list(_records)
+
+    events = [
+        {
+            "name": record["name"],
+            "ph": "X",
+            "ts": record["start"] * 1e6,
+            "dur": record["wall"] * 1e6,
+            "pid": os.getpid(),
+            "tid": record["tid"],
+            "args": dict(record["args"], cpu_ms=record["cpu"] * 1000,
+                         peak_kb=None if record["peak"] is None else record["peak"] / 1024),
+        }
+        for record in records
+    ]
+
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def write_chrome_trace(path: str):
+    """ Write the recorded stages as a Chrome trace JSON file """
+
+    with open(path, "w") as file:
+        json.dump(chrome_trace(), file, default=str)
+
+
+def flush():
+    """ Write the Chrome trace, if one is being recorded, which happens automatically when the program exits
+
+    Worker processes started after the instrumentation was enabled write their own `<name>.<pid>.json` file next to
+    the trace of the main process.
+    """
+
+    if _sink is None or not _sink.endswith(".json"):
+        return
+
+    path = _sink
+    if os.getpid() != _sink_pid:
+        root, extension = os.path.splitext(_sink)
+        path = root + "." + str(os.getpid()) + extension
+
+    write_chrome_trace(path)
+
+
+if os.environ.get(TRACE_ENV):
+    enable(os.environ[TRACE_ENV])
@@ -1,19 +1,472 @@
 import argparse
+import os
 import sys
 
-import matplotlib.pyplot as plt
+# The GUI, plotting and reconstruction modules take most of the start up time, so every command imports only what it
+# needs when it runs
 
-from gui import VascuSensGUI
-from visualisation import greit_visualisation
-from filehelpers import open_file_at_frequency
+# Number of packages listed by --profile-startup
+PROFILE_STARTUP_TOP = 20
+
+
+def add_engine_arguments(parser):
+    """ Add the options choosing the mesh and image resolution of the reconstruction to a parser or argument group """
+
+    parser.add_argument("--preset",
+                        default="standard",
+                        type=str,
+                        help="The mesh and image resolution: 'preview' for a coarse mesh and a 16x16 image, " +
+                        "'standard' for a 32x32 image or 'diagnostic' for a fine mesh and a 64x64 image, by default " +
+                        "standard")
+    parser.add_argument("--h0",
+                        default=None,
+                        type=float,
+                        help="The initial mesh element size, overriding the preset")
+    parser.add_argument("--grid",
+                        default=None,
+                        type=int,
+                        help="The number of image pixels along each side, overriding the preset")
+    parser.add_argument("--forward",
+                        default="exact",
+                        choices=("exact", "linear"),
+                        help="The forward model: 'exact' solves the FEM problem of every frame, 'linear' uses a " +
+                        "precomputed Jacobian, which is much faster but approximate, by default exact")
+
+
+def engine_params(args: argparse.Namespace, parser: argparse.ArgumentParser):
+    """ Return the reconstruction engine parameters chosen by the options from `add_engine_arguments`
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        the parsed command line arguments
+    parser : argparse.ArgumentParser
+        the parser, used to report an unknown preset
+
+    Returns
+    -------
+    dict
+        the `h0`, `grid` and `forward` parameters of the engine, see `reconstruction.get_engine`
+    """
+
+    # Imported here, after parsing, so that --help stays fast
+    from reconstruction import PRESETS
+
+    if args.preset not in PRESETS:
+        parser.error("unknown preset '" + args.preset + "', expected one of " + ", ".join(PRESETS))
+
+    params = dict(PRESETS[args.preset])
+    if args.h0 is not None:
+        params["h0"] = args.h0
+    if args.grid is not None:
+        params["grid"] = args.grid
+    params["forward"] = args.forward
+
+    return params
+
+
+def convert(argv: list[str]):
+    """ Convert a directory of .xlsx recordings to the native binary recording format
+
+    Parameters
+    ----------
+    argv : list[str]
+        the command line arguments following the `convert` command
+    """
+
+    from filehelpers import convert_directory
+
+    parser = argparse.ArgumentParser(
+        prog="main.py convert",
+        description="Convert .xlsx recordings to the native binary recording format (.npz), which loads much faster.")
+    parser.add_argument("source",
+                        type=str,
+                        help="A path string to a directory of .xlsx files, searched recursively, or to one .xlsx file")
+    parser.add_argument("-o",
+                        "--output",
+                        default=None,
+                        type=str,
+                        help="A path string to the directory to write the .npz files to, by default next to each " +
+                        ".xlsx file")
+    args = parser.parse_args(argv)
+
+    written = convert_directory(args.source, args.output)
+    print("Converted " + str(len(written)) + " recording(s)")
+
+
+def batch(argv: list[str]):
+    """ Process a directory of recordings in parallel without a display
+
+    Parameters
+    ----------
+    argv : list[str]
+        the command line arguments following the `batch` command
+    """
+
+    # Imported here as it selects the non-interactive matplotlib backend
+    from batch import find_inputs, parse_frequencies, run_batch
+
+    parser = argparse.ArgumentParser(
+        prog="main.py batch",
+        description="Reconstruct many recordings in parallel and write heatmap images (.png) and the reconstructed " +
+        "images as arrays (.npz) to an output directory.")
+    parser.add_argument("inputs",
+                        nargs="+",
+                        type=str,
+                        help="Path strings to directories of .xlsx or .npz files, or glob patterns")
+    parser.add_argument("-o",
+                        "--output",
+                        required=True,
+                        type=str,
+                        help="A path string to the directory to write the results to")
+    parser.add_argument("-c",
+                        "--frequencies",
+                        default="100",
+                        type=str,
+                        help="The frequencies to process, as comma separated whole numbers or ranges between 20 and " +
+                        "100 inclusive, e.g. '20,50-60', by default 100")
+    parser.add_argument("-b",
+                        "--baseline-path",
+                        default="",
+                        type=str,
+                        help="A path string to a .xlsx or .npz file to be used as a baseline")
+    parser.add_argument("-f",
+                        "--flatten",
+                        default=None,
+                        type=float,
+                        help="The number of standard deviations to which data normalisation should flatten high " +
+                        "values, will not flatten if not passed")
+    parser.add_argument("-j",
+                        "--workers",
+                        default=None,
+                        type=int,
+                        help="The number of worker processes, by default the number of CPUs")
+    parser.add_argument("--figures",
+                        action="store_true",
+                        help="Render full figures with a colour bar instead of plain heatmaps, which is much slower")
+    add_engine_arguments(parser)
+    args = parser.parse_args(argv)
+
+    input_paths = find_inputs(args.inputs)
+    freqs = parse_frequencies(args.frequencies)
+
+    def progress(input_path, error):
+        status = "failed: " + str(error) if error is not None else "done"
+        print(input_path + ": " + status)
+
+    try:
+        failures = run_batch(input_paths, args.output, freqs, baseline_path=args.baseline_path,
+                             flatten=args.flatten, workers=args.workers, figures=args.figures,
+                             engine_params=engine_params(args, parser), progress=progress)
+    except ValueError as error:
+        parser.error(str(error))
+    print("Processed " + str(len(input_paths) - len(failures)) + " of " + str(len(input_paths)) + " recording(s)")
+
+    if failures:
+        sys.exit(1)
+
+
+def stream(argv: list[str]):
+    """ Reconstruct frames continuously as they arrive from stdin, a named pipe or a local socket
+
+    Parameters
+    ----------
+    argv : list[str]
+        the command line arguments following the `stream` command
+    """
+
+    import os
+
+    import numpy as np
+
+    from export import export_png
+    from filehelpers import FREQUENCIES, load_recording
+    from reconstruction import get_engine
+    from stream import open_source, read_frames, report_bad_frame, stream_reconstructions
+
+    parser = argparse.ArgumentParser(
+        prog="main.py stream",
+        description="Reconstruct a continuous stream of 32 value frames as they arrive.")
+    parser.add_argument("source",
+                        nargs="?",
+                        default="-",
+                        type=str,
+                        help="'-' for stdin, 'tcp:HOST:PORT' or 'unix:PATH' to connect to a local socket, or a path " +
+                        "string to a file or named pipe, by default stdin")
+    parser.add_argument("--framing",
+                        default="csv",
+                        choices=["csv", "binary"],
+                        help="'csv' for one frame of comma separated values per line, or 'binary' for frames of 32 " +
+                        "little-endian float64 values, by default csv")
+    parser.add_argument("-o",
+                        "--output",
+                        default=None,
+                        type=str,
+                        help="A path string to a directory to write a heatmap image (.png) of every frame to")
+    parser.add_argument("-b",
+                        "--baseline-path",
+                        default="",
+                        type=str,
+                        help="A path string to a .xlsx or .npz file to be used as a baseline")
+    parser.add_argument("-c",
+                        "--frequency",
+                        default=100,
+                        type=int,
+                        help="The frequency of the baseline to use. An integer between 20 and 100 inclusive, by " +
+                        "default 100")
+    parser.add_argument("-f",
+                        "--flatten",
+                        default=None,
+                        type=float,
+                        help="The number of standard deviations to which data normalisation should flatten high " +
+                        "values, will not flatten if not passed")
+    add_engine_arguments(parser)
+    args = parser.parse_args(argv)
+
+    if args.frequency not in FREQUENCIES:
+        parser.error("Please enter a whole number frequency between 20 and 100 inclusive")
+
+    engine = get_engine(**engine_params(args, parser))
+    baseline_data = None
+    if args.baseline_path:
+        try:
+            baseline_data = load_recording(args.baseline_path).at_frequency(args.frequency)
+        except (ValueError, OSError) as error:
+            parser.error(str(error))
+    if args.output:
+        os.makedirs(args.output, exist_ok=True)
+
+    # Malformed frames are reported and skipped, and counted for the summary at the end of the stream
+    skipped = []
+
+    def bad_frame(error):
+        skipped.append(error)
+        report_bad_frame(error)
+
+    with open_source(args.source) as file:
+        frames = read_frames(file, args.framing, on_bad_frame=bad_frame)
+        images = stream_reconstructions(frames, baseline_data, args.flatten, engine)
+        for index, ds in enumerate(images):
+            if args.output:
+                export_png(os.path.join(args.output, "frame_" + str(index).zfill(6) + ".png"), ds)
+
+            print("frame " + str(index) + ": max " + format(np.nanmax(ds), ".4g"), flush=True)
+
+    if skipped:
+        print("Skipped " + str(len(skipped)) + " malformed frame(s)", file=sys.stderr)
+
+
+def serve(argv: list[str]):
+    """ Serve reconstructions over HTTP from warm engines
+
+    Parameters
+    ----------
+    argv : list[str]
+        the command line arguments following the `serve` command
+    """
+
+    from server import MAX_BATCH_DELAY, MAX_BATCH_SIZE, run_server
+
+    parser = argparse.ArgumentParser(
+        prog="main.py serve",
+        description="Serve reconstructions over HTTP, batching concurrent requests into shared solves.")
+    parser.add_argument("--host",
+                        default="127.0.0.1",
+                        type=str,
+                        help="The address to listen on, by default only the local machine")
+    parser.add_argument("-p",
+                        "--port",
+                        default=8000,
+                        type=int,
+                        help="The TCP port to listen on, by default 8000")
+    parser.add_argument("--unix",
+                        default=None,
+                        type=str,
+                        help="A path string to a Unix socket to listen on instead of a TCP port")
+    parser.add_argument("--max-batch",
+                        default=MAX_BATCH_SIZE,
+                        type=int,
+                        help="The number of frames that are solved together, by default " + str(MAX_BATCH_SIZE))
+    parser.add_argument("--max-delay",
+                        default=MAX_BATCH_DELAY * 1000,
+                        type=float,
+                        help="The milliseconds a frame waits for others to be solved with, by default " +
+                        format(MAX_BATCH_DELAY * 1000, "g"))
+    args = parser.parse_args(argv)
+
+    def ready(server):
+        print("Listening on " + (args.unix or args.host + ":" + str(args.port)), flush=True)
+
+    run_server(args.host, args.port, args.unix, args.max_batch, args.max_delay / 1000, ready)
+
+
+def benchmark(argv: list[str]):
+    """ Time every stage of the reconstruction pipeline and optionally compare with an earlier run
+
+    Parameters
+    ----------
+    argv : list[str]
+        the command line arguments following the `benchmark` command
+    """
+
+    # Imported here as it selects the non-interactive matplotlib backend
+    from benchmark import (DEFAULT_DATA_DIR, DEFAULT_FREQUENCY_COUNTS, DEFAULT_H0, DEFAULT_REPEAT, DEFAULT_THRESHOLD,
+                           compare, load_results, run_benchmarks, save_results)
+
+    parser = argparse.ArgumentParser(
+        prog="main.py benchmark",
+        description="Time every stage of the reconstruction pipeline over the bundled data sets, mesh densities and " +
+        "numbers of frequencies, and write the results as JSON.")
+    parser.add_argument("-o",
+                        "--output",
+                        default="benchmark.json",
+                        type=str,
+                        help="A path string to the JSON file to write the results to, by default benchmark.json")
+    parser.add_argument("-d",
+                        "--data-dir",
+                        default=DEFAULT_DATA_DIR,
+                        type=str,
+                        help="A path string to a directory holding one directory of .xlsx recordings per data set, " +
+                        "by default the bundled data")
+    parser.add_argument("--h0",
+                        default=",".join(str(h0) for h0 in DEFAULT_H0),
+                        type=str,
+                        help="Comma separated mesh densities, by default " + ",".join(str(h0) for h0 in DEFAULT_H0))
+    parser.add_argument("-n",
+                        "--frequency-counts",
+                        default=",".join(str(n) for n in DEFAULT_FREQUENCY_COUNTS),
+                        type=str,
+                        help="Comma separated numbers of frequencies to reconstruct, by default " +
+                        ",".join(str(n) for n in DEFAULT_FREQUENCY_COUNTS))
+    parser.add_argument("-r",
+                        "--repeat",
+                        default=DEFAULT_REPEAT,
+                        type=int,
+                        help="The number of times every stage is run, by default " + str(DEFAULT_REPEAT))
+    parser.add_argument("--no-figures",
+                        action="store_true",
+                        help="Do not time rendering matplotlib figures, which is the slowest stage")
+    parser.add_argument("--compare",
+                        default=None,
+                        type=str,
+                        help="A path string to the results of an earlier run to compare with")
+    parser.add_argument("--threshold",
+                        default=DEFAULT_THRESHOLD,
+                        type=float,
+                        help="The slowdown factor reported as a regression, by default " + str(DEFAULT_THRESHOLD))
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.data_dir, [float(h0) for h0 in args.h0.split(",")],
+                             [int(n) for n in args.frequency_counts.split(",")], args.repeat, not args.no_figures,
+                             progress=lambda description: print("Benchmarking " + description, flush=True))
+    save_results(args.output, results)
+    print("Wrote " + str(len(results["results"])) + " results to " + args.output)
+
+    if args.compare:
+        comparison = compare(load_results(args.compare), results, args.threshold)
+        regressions = [result for result in comparison if result["regression"]]
+        for result in regressions:
+            print("Regression: " + result["stage"] + " " + result["dataset"] + "/" + result["file"] + " h0=" +
+                  str(result["h0"]) + " n_freq=" + str(result["n_freq"]) + ": " + format(result["old"], ".4f") +
+                  " s -> " + format(result["new"], ".4f") + " s (x" + format(result["ratio"], ".2f") + ")")
+        print(str(len(regressions)) + " regression(s) in " + str(len(comparison)) + " compared results")
+
+        if regressions:
+            sys.exit(1)
+
+
+# Commands that can be given as the first command line argument
+COMMANDS = {"convert": convert, "batch": batch, "stream": stream, "serve": serve, "benchmark": benchmark}
+
+
+def profile_startup(argv: list[str]):
+    """ Run the program with the given arguments and report the time spent importing each package
+
+    The program runs in a new interpreter with Python's `-X importtime` option, whose report is summed per top level
+    package.
+
+    Parameters
+    ----------
+    argv : list[str]
+        the command line arguments to run the program with
+    """
+
+    import subprocess
+    import time
+
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, "-X", "importtime", __file__] + argv, stderr=subprocess.PIPE, text=True)
+    elapsed = time.perf_counter() - start
+
+    # Lines look like "import time: self [us] | cumulative | imported package", nested imports are indented
+    packages = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:"):
+            sys.stderr.write(line + "\n")
+            continue
+
+        fields = line[len("import time:"):].split("|")
+        if not fields[0].strip().isdigit():
+            continue
+
+        package = fields[2].strip().split(".")[0]
+        packages[package] = packages.get(package, 0) + int(fields[0])
+
+    total = sum(packages.values())
+    print("Import time by package (" + format(total / 1e6, ".3f") + " s of " + format(elapsed, ".3f") + " s total):",
+          file=sys.stderr)
+    for package, self_time in sorted(packages.items(), key=lambda item: -item[1])[:PROFILE_STARTUP_TOP]:
+        print("  " + format(self_time / 1e6, "8.3f") + " s  " + package, file=sys.stderr)
+
+    sys.exit(process.returncode)
+
+
+def run_gui():
+    """ Create and run the gui window loop """
+
+    from gui import main as gui_main
+
+    gui_main()
 
 
 def main():
     """ Main method of the Vascusense project. """
 
+    # Report the import time of a run with the other arguments
+    if "--profile-startup" in sys.argv[1:]:
+        profile_startup([arg for arg in sys.argv[1:] if arg != "--profile-startup"])
+        return
+
+    # Record the time and memory of every stage, as JSON lines on stderr or as a Chrome trace file
+    for index, arg in enumerate(sys.argv[1:], 1):
+        if arg == "--trace" or arg.startswith("--trace="):
+            import instrument
+
+            # "--trace PATH" takes the next argument unless it is an option, a command or a recording to process
+            sink = arg.partition("=")[2]
+            following = sys.argv[index + 1] if arg == "--trace" and index + 1 < len(sys.argv) else None
+            if following is not None and not (following.startswith("-") or following in COMMANDS or
+                                              following.endswith((".xlsx", ".npz")) or os.path.isdir(following)):
+                sink = sys.argv.pop(index + 1)
+
+            instrument.enable(sink or "log")
+            sys.argv.pop(index)
+            break
+
+    # Run a command if one was given as the first argument
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        COMMANDS[sys.argv[1]](sys.argv[2:])
+        return
+
     # CLI argparse
     parser = argparse.ArgumentParser(
-        description="Read in an excel spreadsheet (.xlsx) and process the data into a heatmap image.",
+        description="Read in an excel spreadsheet (.xlsx) or a converted recording (.npz) and process the data into " +
+        "a heatmap image.",
+        epilog="commands: 'convert' converts .xlsx recordings to .npz, 'batch' processes many recordings in " +
+        "parallel without a display, 'stream' reconstructs a continuous stream of frames, 'serve' serves " +
+        "reconstructions over HTTP, 'benchmark' times the reconstruction pipeline, see 'main.py [COMMAND] " +
+        "--help'. Add --profile-startup to any command line to report the time spent importing each package, or " +
+        "--trace to record the time and memory of every stage",
         exit_on_error=False)
 
     # Create mutually exclusive arg group for separate GUI and CLI functionality
@@ -22,6 +475,17 @@ def main():
     # Add GUI option
     group.add_argument("--gui", action="store_true", help="Whether to run the program with a gui or not")
 
+    # Handled before parsing, listed here for the help message
+    parser.add_argument("--profile-startup",
+                        action="store_true",
+                        help="Report the time spent importing each package when the program is run")
+    parser.add_argument("--trace",
+                        nargs="?",
+                        const="log",
+                        metavar="PATH",
+                        help="Record the time and memory of every stage, as JSON lines on stderr, or as a Chrome " +
+                        "trace with --trace PATH.json. Also enabled by the VASCUSENS_TRACE environment variable")
+
     # Create CLI argument group
     cli_argument_group = group.add_argument_group()
 
@@ -29,7 +493,7 @@ def main():
     cli_argument_group.add_argument("-i",
                                     "--input",
                                     type=str,
-                                    help="A path string to a .xlsx file")
+                                    help="A path string to a .xlsx or .npz file")
     cli_argument_group.add_argument("-c",
                                     "--frequency",
                                     default=100,
@@ -40,19 +504,22 @@ def main():
                                     "--baseline-path",
                                     default="",
                                     type=str,
-                                    help="A path string to a .xlsx file to be used as a baseline")
+                                    help="A path string to a .xlsx or .npz file to be used as a baseline")
     cli_argument_group.add_argument("-f",
                                     "--flatten",
                                     default=None,
                                     type=float,
                                     help="The number of standard deviations to which data normalisation should flatt" +
                                     "en high values, will not flatten if not passed")
+    cli_argument_group.add_argument("--validate-forward",
+                                    action="store_true",
+                                    help="Report the error of the linear forward model against the exact solve for " +
+                                    "the input")
+    add_engine_arguments(cli_argument_group)
 
     # Detect if the script was run without arguments, in which case the gui is used
     if len(sys.argv) == 1:
-        # Create and run gui window loop
-        program = VascuSensGUI()
-        program.window.mainloop()
+        run_gui()
 
     # Else program is run through the CLI
     else:
@@ -60,26 +527,51 @@ def main():
 
         # Runs through CLI if GUI tag is missing/set to False
         if not args.gui:
+            import matplotlib.pyplot as plt
+
+            from filehelpers import open_file_at_frequency
+            from reconstruction import get_engine
+            from visualisation import greit_visualisation
+
             input_path = args.input
             freq = args.frequency
             baseline_path = args.baseline_path
             flatten = args.flatten
+            engine = get_engine(**engine_params(args, parser))
 
             # Open data files
             input_data, baseline_data = open_file_at_frequency(input_path, freq, baseline_path)
 
+            # Compare the linear forward model with the exact solve for the input
+            if args.validate_forward:
+                from reconstruction import preprocess_batch
+
+                error = engine.linear_error(engine.anomaly_perms(preprocess_batch(input_data, baseline_data,
+                                                                                  flatten)))
+                print("Linear forward error: voltages " + format(error["voltage"][0] * 100, ".3g") + " %, image " +
+                      format(error["image"][0] * 100, ".3g") + " %")
+
             # Create and show plot of the data
-            fig = greit_visualisation(input_data, baseline_data=baseline_data, flatten=flatten)  # noqa: F841
+            fig = greit_visualisation(input_data, baseline_data=baseline_data, flatten=flatten,  # noqa: F841
+                                      engine=engine)
             plt.show()
 
         else:
-            # Create and run gui window loop
-            program = VascuSensGUI()
-            program.window.mainloop()
+            run_gui()
 
 
 # Run main script in command line with:
-# python main.py -i [INPUT] -c [FREQUENCY] -b [BASELINE_PATH] -f [FLATTEN]
+# python main.py -i [INPUT] -c [FREQUENCY] -b [BASELINE_PATH] -f [FLATTEN] --preset [PRESET] --h0 [H0] --grid [PIXELS]
+#   --forward [exact|linear] --validate-forward
 # python main.py --gui
+# python main.py convert [SOURCE] -o [OUTPUT_DIR]
+# python main.py batch [INPUTS ...] -o [OUTPUT_DIR] -c [FREQUENCIES] -b [BASELINE_PATH] -f [FLATTEN] -j [WORKERS]
+#   --preset [PRESET]
+# python main.py stream [SOURCE] --framing [csv|binary] -o [OUTPUT_DIR] -b [BASELINE_PATH] -c [FREQUENCY] -f [FLATTEN]
+#   --preset [PRESET]
+# python main.py serve --host [HOST] -p [PORT] --unix [SOCKET_PATH] --max-batch [FRAMES] --max-delay [MILLISECONDS]
+# python main.py benchmark -o [OUTPUT_JSON] --h0 [MESH_DENSITIES] -n [FREQUENCY_COUNTS] -r [REPEAT] --compare [OLD]
+# python main.py [ARGUMENTS ...] --profile-startup
+# python main.py [ARGUMENTS ...] --trace [TRACE_PATH]
 if __name__ == "__main__":
     main()
@@ -0,0 +1,432 @@
+import asyncio
+import io
+import json
+from functools import partial
+
+import numpy as np
+
+from export import encode_png, render_array
+from filehelpers import FREQUENCIES, Recording
+from reconstruction import DEFAULT_PRESET, FORWARD_MODES, PRESETS, preprocess_batch, preset_engine
+from stream import FRAME_SIZE
+
+# Largest number of frames solved together, and the longest a frame waits for others to join its batch
+MAX_BATCH_SIZE = 64
+MAX_BATCH_DELAY = 0.005
+
+# Largest request body accepted, in bytes, and largest number of frames reconstructed for one request
+MAX_BODY_SIZE = 16 * 1024 * 1024
+MAX_FRAMES = 4096
+
+# Engine parameters a request may choose, limited to the presets and forward models so that requests cannot make
+# the server build and keep an unbounded number of engines, or one on a mesh too fine to build
+ENGINE_PARAMS = ("preset", "forward")
+
+# Largest number of headers accepted in a request, the length of each line is limited by the stream reader
+MAX_HEADERS = 100
+
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+               413: "Payload Too Large", 431: "Request Header Fields Too Large", 500: "Internal Server Error"}
+
+
+class RequestError(Exception):
+    """ An error in a request, reported to the client with an HTTP status """
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class Batcher:
+    """ Coalesces the anomaly permittivities of concurrent requests into batched solves on one engine
+
+    Rows are collected until `max_batch` rows are waiting or the oldest has waited `max_delay` seconds, then solved
+    together on a worker thread.
+
+    Parameters
+    ----------
+    engine : ReconstructionEngine
+        the engine to solve with
+    max_batch : int, optional
+        number of rows that triggers a solve straight away, by default MAX_BATCH_SIZE
+    max_delay : float, optional
+        seconds a row waits for others before it is solved, by default MAX_BATCH_DELAY
+    """
+
+    def __init__(self, engine, max_batch: int = MAX_BATCH_SIZE, max_delay: float = MAX_BATCH_DELAY):
+        self.engine = engine
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._pending = []
+        self._size = 0
+        self._timer = None
+
+        # Number of solves and rows solved, for monitoring how well requests are batched
+        self.batches = 0
+        self.rows = 0
+
+    async def solve(self, perms: np.ndarray):
+        """ Reconstruct the images of N x n_tri anomaly permittivities, batched with any concurrent requests
+
+        Returns
+        -------
+        np.ndarray
+            N x ny x nx array of reconstructed images, with `NaN` outside of the mesh
+        """
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((perms, future))
+        self._size += len(perms)
+
+        if self._size >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_delay, self._flush)
+
+        return await future
+
+    def _flush(self):
+        """ Start solving every pending row """
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        pending, self._pending, self._size = self._pending, [], 0
+        if pending:
+            asyncio.get_running_loop().create_task(self._solve(pending))
+
+    async def _solve(self, pending: list):
+        """ Solve the pending rows in one batch on a worker thread and hand each request its images """
+
+        perms = np.concatenate([perms for perms, _ in pending])
+        self.batches += 1
+        self.rows += len(perms)
+
+        try:
+            images = await asyncio.get_running_loop().run_in_executor(
+                None, lambda: self.engine.solve(self.engine.forward_voltages(perms))
+            )
+        except Exception as error:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(error)
+            return
+
+        start = 0
+        for request_perms, future in pending:
+            if not future.done():
+                future.set_result(images[start:start + len(request_perms)])
+            start += len(request_perms)
+
+
+def parse_frames(body: dict):
+    """ Extract the frames of a reconstruction request
+
+    A request holds either `frames`, a single frame or a list of 32 value frames, with an optional `baseline` frame
+    or list of frames, or `recording`, a 32 x n_freq array of readings with its `frequencies`, reconstructed at the
+    frequencies in `freqs` with an optional `baseline_recording` of the same layout.
+
+    Parameters
+    ----------
+    body : dict
+        the decoded JSON body of the request
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray | None]
+        N x 32 input frames, and N x 32 baseline frames or `None`
+    """
+
+    if "recording" in body:
+        frequencies = body.get("frequencies", FREQUENCIES)
+        recording = Recording(body["recording"], frequencies=frequencies)
+        freqs = body.get("freqs", recording.frequencies)
+        frames = np.array([recording.at_frequency(freq) for freq in freqs])
+
+        baseline_frames = None
+        if body.get("baseline_recording") is not None:
+            baseline = Recording(body["baseline_recording"], frequencies=frequencies)
+            baseline_frames = np.array([baseline.at_frequency(freq) for freq in freqs])
+    elif "frames" in body:
+        frames = np.atleast_2d(np.asarray(body["frames"], dtype=np.float64))
+
+        baseline_frames = None
+        if body.get("baseline") is not None:
+            baseline_frames = np.atleast_2d(np.asarray(body["baseline"], dtype=np.float64))
+            baseline_frames = np.broadcast_to(baseline_frames, frames.shape)
+    else:
+        raise ValueError("Request must hold 'frames' or 'recording'")
+
+    if frames.ndim != 2 or frames.shape[1] != FRAME_SIZE:
+        raise ValueError("Frames must have " + str(FRAME_SIZE) + " values each, got an array of shape " +
+                         str(frames.shape))
+
+    return frames, baseline_frames
+
+
+class ReconstructionServer:
+    """ HTTP server reconstructing frames and recordings with warm engines and batched solves
+
+    Requests are JSON objects posted to `/reconstruct`, see `parse_frames` for the input. The optional `flatten` is the
+    number of standard deviations to which data normalisation should flatten high values, `engine` may name a preset
+    of `reconstruction.PRESETS` or be an object choosing the `preset` and the `forward` model of the engine, and
+    `format` selects the response: "json" for the images as nested lists with `null` outside of the mesh, "npy" for
+    the N x ny x nx array in NumPy's .npy format, or "png" for a heatmap of a single image. `GET /health` reports the
+    warm engines and how requests were batched.
+
+    Parameters
+    ----------
+    max_batch : int, optional
+        number of frames that triggers a solve straight away, by default MAX_BATCH_SIZE
+    max_delay : float, optional
+        seconds a frame waits for others before it is solved, by default MAX_BATCH_DELAY
+    """
+
+    def __init__(self, max_batch: int = MAX_BATCH_SIZE, max_delay: float = MAX_BATCH_DELAY):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+
+        # One batcher around a warm engine per preset and forward model
+        self.batchers = {}
+
+    async def batcher(self, params: dict):
+        """ Return the batcher of the engine for the given parameters or preset, building the engine on first use """
+
+        if isinstance(params, str):
+            params = {"preset": params}
+
+        if not isinstance(params, dict):
+            raise ValueError("Engine parameters must be a JSON object or the name of a preset")
+
+        unknown = set(params) - set(ENGINE_PARAMS)
+        if unknown:
+            raise ValueError("Unknown engine parameters " + ", ".join(sorted(unknown)) + ", expected " +
+                             " or ".join(ENGINE_PARAMS))
+
+        preset = params.get("preset", DEFAULT_PRESET)
+        forward = params.get("forward", "exact")
+        if not isinstance(preset, str) or preset not in PRESETS:
+            raise ValueError("Unknown preset '" + str(preset) + "', expected one of " + ", ".join(PRESETS))
+        if not isinstance(forward, str) or forward not in FORWARD_MODES:
+            raise ValueError("Unknown forward model '" + str(forward) + "', expected one of " +
+                             ", ".join(FORWARD_MODES))
+
+        key = (preset, forward)
+        if key not in self.batchers:
+            engine = await asyncio.get_running_loop().run_in_executor(
+                None, partial(preset_engine, preset, forward=forward)
+            )
+            self.batchers.setdefault(key, Batcher(engine, self.max_batch, self.max_delay))
+
+        return self.batchers[key]
+
+    async def reconstruct(self, body: dict):
+        """ Reconstruct the frames of a request
+
+        Returns
+        -------
+        tuple[str, bytes]
+            the content type and content of the response
+        """
+
+        if not isinstance(body, dict):
+            raise ValueError("Request body must be a JSON object")
+
+        frames, baseline_frames = parse_frames(body)
+        if len(frames) > MAX_FRAMES:
+            raise RequestError(413, "Requests may hold at most " + str(MAX_FRAMES) + " frames, got " +
+                               str(len(frames)))
+        flatten = body.get("flatten")
+        response_format = body.get("format", "json")
+        if response_format == "png" and len(frames) != 1:
+            raise ValueError("The png format needs a single frame")
+        if response_format not in ("json", "npy", "png"):
+            raise ValueError("Unknown format '" + str(response_format) + "', expected 'json', 'npy' or 'png'")
+
+        batcher = await self.batcher(body.get("engine") or {})
+
+        # Preprocess every frame at once on a worker thread, then solve together with any concurrent requests
+        perms = await asyncio.get_running_loop().run_in_executor(
+            None, lambda: batcher.engine.anomaly_perms(preprocess_batch(frames, baseline_frames, flatten))
+        )
+        images = await batcher.solve(perms)
+
+        if response_format == "png":
+            return "image/png", encode_png(render_array(images[0]))
+
+        if response_format == "npy":
+            buffer = io.BytesIO()
+            np.save(buffer, images, allow_pickle=False)
+            return "application/octet-stream", buffer.getvalue()
+
+        ds = np.where(np.isnan(images), None, images).tolist()
+        return "application/json", json.dumps({"ds": ds}).encode("utf-8")
+
+    def health(self):
+        """ Describe the warm engines and the batching statistics """
+
+        engines = [
+            {"params": dict(zip(ENGINE_PARAMS, key)), "batches": batcher.batches, "frames": batcher.rows}
+            for key, batcher in self.batchers.items()
+        ]
+
+        return "application/json", json.dumps({"status": "ok", "engines": engines}).encode("utf-8")
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """ Serve the HTTP/1.1 requests of one connection """
+
+        try:
+            while True:
+                # Request line and headers, a line longer than the limit of the reader raises a ValueError
+                try:
+                    request_line = await reader.readline()
+                except ValueError:
+                    error = RequestError(400, "Request line is too long")
+                    await _write_response(writer, error.status, "application/json", _error(error), False)
+                    break
+                if not request_line:
+                    break
+
+                try:
+                    method, path, _ = request_line.decode("latin-1").split()
+                except ValueError:
+                    break
+
+                try:
+                    headers = await _read_headers(reader)
+                except RequestError as error:
+                    await _write_response(writer, error.status, "application/json", _error(error), False)
+                    break
+
+                keep_alive = headers.get("connection", "").lower() != "close"
+
+                try:
+                    # The body cannot be skipped without a valid length, so the connection is closed after the error
+                    try:
+                        length = int(headers.get("content-length", 0) or 0)
+                    except ValueError:
+                        length = -1
+                    if length < 0:
+                        keep_alive = False
+                        raise RequestError(400, "Invalid Content-Length header")
+
+                    if length > MAX_BODY_SIZE:
+                        keep_alive = False
+                        raise RequestError(413, "Request body is larger than " + str(MAX_BODY_SIZE) + " bytes")
+
+                    body = await reader.readexactly(length) if length else b""
+                    status, (content_type, content) = 200, await self.route(method, path.split("?")[0], body)
+                except RequestError as error:
+                    status, content_type, content = error.status, "application/json", _error(error)
+                except (ValueError, KeyError, TypeError) as error:
+                    status, content_type, content = 400, "application/json", _error(error)
+                except Exception as error:
+                    status, content_type, content = 500, "application/json", _error(error)
+
+                await _write_response(writer, status, content_type, content, keep_alive)
+
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method: str, path: str, body: bytes):
+        """ Dispatch a request to its handler """
+
+        if path == "/health":
+            if method != "GET":
+                raise RequestError(405, "Use GET for " + path)
+            return self.health()
+
+        if path == "/reconstruct":
+            if method != "POST":
+                raise RequestError(405, "Use POST for " + path)
+            return await self.reconstruct(json.loads(body or b"null"))
+
+        raise RequestError(404, "Unknown path " + path)
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8000, unix_path: str = None, ready=None):
+        """ Serve requests until cancelled, on a TCP port or a Unix socket
+
+        Parameters
+        ----------
+        host : str, optional
+            address to listen on, by default only the local machine
+        port : int, optional
+            TCP port to listen on, by default 8000
+        unix_path : str, optional
+            path string of a Unix socket to listen on instead of a TCP port, by default `None`
+        ready : callable, optional
+            called with the server once it is listening
+        """
+
+        # Warm the default engine before accepting requests
+        await self.batcher({})
+
+        if unix_path:
+            server = await asyncio.start_unix_server(self.handle, path=unix_path)
+        else:
+            server = await asyncio.start_server(self.handle, host=host, port=port)
+
+        if ready is not None:
+            ready(server)
+
+        async with server:
+            await server.serve_forever()
+
+
+async def _read_headers(reader: asyncio.StreamReader):
+    """ Read the headers of a request, by lower case name
+
+    Raises
+    ------
+    RequestError
+        if a header line is longer than the limit of the reader, or there are more than MAX_HEADERS headers
+    """
+
+    headers = {}
+    for count in range(MAX_HEADERS + 1):
+        try:
+            line = await reader.readline()
+        except ValueError:
+            raise RequestError(431, "Request header line is too long")
+
+        if line in (b"\r\n", b"\n", b""):
+            return headers
+        if count == MAX_HEADERS:
+            raise RequestError(431, "Requests may have at most " + str(MAX_HEADERS) + " headers")
+
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+
+async def _write_response(writer: asyncio.StreamWriter, status: int, content_type: str, content: bytes,
+                          keep_alive: bool):
+    """ Write an HTTP response """
+
+    writer.write(("HTTP/1.1 " + str(status) + " " + STATUS_TEXT[status] + "\r\n" +
+                  "Content-Type: " + content_type + "\r\n" +
+                  "Content-Length: " + str(len(content)) + "\r\n" +
+                  "Connection: " + ("keep-alive" if keep_alive else "close") + "\r\n\r\n")
+                 .encode("latin-1") + content)
+    await writer.drain()
+
+
+def _error(error: Exception):
+    """ Encode an error as a JSON response body """
+
+    return json.dumps({"error": str(error)}).encode("utf-8")
+
+
+def run_server(host: str = "127.0.0.1", port: int = 8000, unix_path: str = None, max_batch: int = MAX_BATCH_SIZE,
+               max_delay: float = MAX_BATCH_DELAY, ready=None):
+    """ Run a `ReconstructionServer` until interrupted, see `ReconstructionServer.serve` for the parameters """
+
+    try:
+        asyncio.run(ReconstructionServer(max_batch, max_delay).serve(host, port, unix_path, ready))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,69 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# Alignment of every array in a shared memory block, in bytes
+ALIGNMENT = 64
+
+
+def publish(arrays: dict):
+    """ Copy arrays into one block of shared memory that other processes can attach to with `attach`
+
+    The block stays allocated until the returned `SharedMemory` is unlinked, which the publishing process must do
+    once no process needs the arrays any more.
+
+    Parameters
+    ----------
+    arrays : dict[str, np.ndarray]
+        the arrays to share by name
+
+    Returns
+    -------
+    tuple[shared_memory.SharedMemory, dict]
+        the shared memory block, and a picklable handle describing it to pass to `attach`
+    """
+
+    # Lay out the arrays one after the other, each aligned
+    layout, size = {}, 0
+    for name, array in arrays.items():
+        array = np.asarray(array)
+        size = -(-size // ALIGNMENT) * ALIGNMENT
+        layout[name] = (array.dtype.str, array.shape, size)
+        size += array.nbytes
+
+    block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    for name, array in arrays.items():
+        dtype, shape, offset = layout[name]
+        np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=offset)[...] = array
+
+    return block, {"name": block.name, "arrays": layout}
+
+
+def attach(handle: dict):
+    """ Attach to a block of shared memory created by `publish`, without copying the arrays
+
+    Parameters
+    ----------
+    handle : dict
+        the handle returned by `publish`
+
+    Returns
+    -------
+    tuple[shared_memory.SharedMemory, dict[str, np.ndarray]]
+        the shared memory block, which must be kept open as long as the arrays are used, and the read-only arrays by
+        name
+    """
+
+    # Only the publishing process unlinks the block, so attaching processes do not track it where Python allows
+    try:
+        block = shared_memory.SharedMemory(name=handle["name"], track=False)
+    except TypeError:
+        block = shared_memory.SharedMemory(name=handle["name"])
+
+    arrays = {}
+    for name, (dtype, shape, offset) in handle["arrays"].items():
+        array = np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=offset)
+        array.flags.writeable = False
+        arrays[name] = array
+
+    return block, arrays
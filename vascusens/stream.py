@@ -0,0 +1,191 @@
+import socket
+import sys
+from contextlib import contextmanager
+
+import numpy as np
+
+import instrument
+from reconstruction import ReconstructionEngine, get_engine, preprocess_batch
+
+# Values in every frame, two readings per electrode
+FRAME_SIZE = 32
+
+# Binary frames are packed little-endian float64 values
+BINARY_DTYPE = np.dtype("<f8")
+
+# Longest CSV line accepted, so a stream without line breaks cannot grow the read buffer without bound
+MAX_LINE_LENGTH = 4096
+
+
+@contextmanager
+def open_source(address: str):
+    """ Open a source of frames as a binary file object
+
+    Parameters
+    ----------
+    address : str
+        "-" for stdin, "tcp:HOST:PORT" or "unix:PATH" to connect to a local socket, or otherwise the path string of a
+        file or named pipe
+
+    Yields
+    ------
+    io.BufferedIOBase
+        the stream of frames, closed when the context exits
+    """
+
+    if address == "-":
+        yield sys.stdin.buffer
+        return
+
+    if address.startswith(("tcp:", "unix:")):
+        kind, _, target = address.partition(":")
+        if kind == "tcp":
+            host, _, port = target.rpartition(":")
+            sock = socket.create_connection((host or "localhost", int(port)))
+        else:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(target)
+
+        with sock, sock.makefile("rb") as file:
+            yield file
+        return
+
+    with open(address, "rb") as file:
+        yield file
+
+
+def report_bad_frame(error: ValueError):
+    """ Report a frame skipped by `read_frames` on stderr """
+
+    print("Skipped a malformed frame: " + str(error), file=sys.stderr, flush=True)
+
+
+def read_frames(file, framing: str = "csv", frame_size: int = FRAME_SIZE, on_bad_frame=report_bad_frame):
+    """ Read frames from a binary stream as they arrive
+
+    Only one frame is held at a time, and each frame is yielded as soon as it is complete. Malformed frames, i.e. CSV
+    lines that are too long, do not hold `frame_size` numbers, or frames with non-finite values, are skipped and
+    reported so that one bad reading does not stop a continuous stream.
+
+    Parameters
+    ----------
+    file : io.BufferedIOBase
+        the stream to read, e.g. from `open_source`
+    framing : str, optional
+        "csv" for one frame per line of comma or whitespace separated values, where blank lines and lines starting
+        with "#" are skipped, or "binary" for frames of `frame_size` packed little-endian float64 values, by default
+        "csv"
+    frame_size : int, optional
+        number of values in every frame, by default FRAME_SIZE
+    on_bad_frame : callable, optional
+        called as `on_bad_frame(error)` with a `ValueError` describing each skipped frame, or `None` to raise the
+        error instead, by default `report_bad_frame`
+
+    Yields
+    ------
+    np.ndarray
+        the values of each frame
+
+    Raises
+    ------
+    ValueError
+        if the framing is unknown, a binary stream ends in the middle of a frame, or a frame is malformed and
+        `on_bad_frame` is `None`
+    """
+
+    def check(frame):
+        if not np.all(np.isfinite(frame)):
+            raise ValueError("Frame holds values that are not finite numbers")
+        return frame
+
+    if framing == "binary":
+        buffer = bytearray(frame_size * BINARY_DTYPE.itemsize)
+        view = memoryview(buffer)
+        while True:
+            # Fill the frame buffer, a partial read is normal for pipes and sockets
+            filled = 0
+            while filled < len(buffer):
+                count = file.readinto(view[filled:])
+                if not count:
+                    if filled:
+                        raise ValueError("Stream ended in the middle of a frame")
+                    return
+                filled += count
+
+            try:
+                frame = check(np.frombuffer(buffer, dtype=BINARY_DTYPE).astype(np.float64))
+            except ValueError as error:
+                if on_bad_frame is None:
+                    raise
+                on_bad_frame(error)
+                continue
+
+            yield frame
+
+    elif framing == "csv":
+        while True:
+            line = file.readline(MAX_LINE_LENGTH + 1)
+            if not line:
+                return
+
+            try:
+                if len(line) > MAX_LINE_LENGTH:
+                    # Discard the rest of the line, still reading at most MAX_LINE_LENGTH characters at a time
+                    while line and not line.endswith(b"\n"):
+                        line = file.readline(MAX_LINE_LENGTH + 1)
+                    raise ValueError("CSV frame is longer than " + str(MAX_LINE_LENGTH) + " characters")
+
+                line = line.strip()
+                if not line or line.startswith(b"#"):
+                    continue
+
+                values = line.replace(b",", b" ").split()
+                if len(values) != frame_size:
+                    raise ValueError("Expected " + str(frame_size) + " values per frame, got " + str(len(values)))
+
+                frame = check(np.array(values, dtype=np.float64))
+            except ValueError as error:
+                if on_bad_frame is None:
+                    raise
+                on_bad_frame(error)
+                continue
+
+            yield frame
+
+    else:
+        raise ValueError("Unknown framing '" + framing + "', expected 'csv' or 'binary'")
+
+
+def stream_reconstructions(frames, baseline_data: list[float] = None, flatten: float = None,
+                           engine: ReconstructionEngine = None):
+    """ Reconstruct frames one at a time as they arrive
+
+    Each frame goes through the same preprocessing as `reconstruct` and a single forward and GREIT solve on an engine
+    that is set up before the first frame, so the latency of every frame is one solve and nothing accumulates.
+
+    Parameters
+    ----------
+    frames : iterable
+        the frames to reconstruct, e.g. from `read_frames`
+    baseline_data : list, optional
+        baseline data for correction of every frame, by default `None`
+    flatten : float, optional
+        the number of standard deviations to which data normalisation should flatten high values, will not flatten if
+        `None`, by default `None`
+    engine : ReconstructionEngine, optional
+        the engine to reconstruct with, by default the shared engine from `get_engine`
+
+    Yields
+    ------
+    np.ndarray
+        the reconstructed image of each frame on the GREIT grid, with `NaN` outside of the mesh
+    """
+
+    engine = engine or get_engine()
+
+    for index, frame in enumerate(frames):
+        with instrument.stage("stream.frame", frame=index):
+            params = preprocess_batch(frame, baseline_data, flatten)
+            ds = engine.solve(engine.forward_voltages(engine.anomaly_perms(params)))[0]
+
+        yield ds